@@ -3,12 +3,23 @@ from __future__ import print_function
 import sys
 import os
 import re
+import errno
 import math
 import argparse
 import webbrowser
 import itertools
 import random
 import threading 
+import email.utils
+import bisect
+import base64
+import hashlib
+import json
+import array
+import timeit
+import mmap
+import struct
+import collections
 
 if sys.version_info < (3,):
     import StringIO
@@ -21,14 +32,24 @@ try:
 except:
     sqlite3_available = False
 
+try:
+    from os import scandir
+except ImportError:
+    # python 2, folders are listed with os.listdir
+    scandir = None
+
 try:
     import xml.etree.cElementTree as ET
 except:
     import xml.etree.ElementTree as ET
 
+import six
 import six.moves.urllib.request as requests
 import six.moves.urllib.error as urllib_error
+import six.moves.urllib.parse as urllib_parse
 import six.moves.configparser as configparser
+import six.moves.queue as queue
+import six.moves.http_client as http_client
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 from PIL import Image, ImageDraw
@@ -72,15 +93,18 @@ MAXZOOM = 18
 # -- Command line parsing ----------------------------------------------------
 
 USAGE = """
-  -describe <db name> [-db_format <db format] [-tile_format <tile format>] [-url_template <url template>]
-  -insert   <db name> <tileset> [-force]
-  -import   <db name> <tileset> [-force] -source <db name>
-  -export   <db name> <tileset> [-force] -dest   <db name>
-  -delete   <db name> <tileset>
-  -view     <db name> <tileset> [-image <image name>]
+  -describe <db name> [-db_format <db format] [-tile_format <tile format>] [-url_template <url template>] [-dedup on|off]
+  -insert   <db name> <tileset> [-force] [-resume] [-order <order>]
+  -import   <db name> <tileset> [-force] -source <db name> [-order <order>]
+  -export   <db name> <tileset> [-force] -dest   <db name> [-order <order>]
+  -delete   <db name> <tileset> [-order <order>]
+  -view     <db name> <tileset> [-image <image name>] [-order <order>]
   -count    <db name> <tileset>
   -stat     <db name> <tileset>
   -server   <db name>
+  -migrate  <db name>
+  -rebuild  <db name>
+  -pack     <db name>
 
 tileset:
   -track <track_filename> -zoom <zoom_level> [-radius <in kilometers>]
@@ -89,10 +113,19 @@ tileset:
   -contours <track_filename> -zoom <zoom_level> [-radius <in kilometers>]
   -project <project_filename>
   -records [-zoom <zoom_level>]
+  -retry_failed [-zoom <zoom_level>] tiles from failure log of last insertions
   -tiles xmin,ymin,xmax,ymax -zoom <zoom_level>
   -inside limits tilesets to the intersection with the argument database
   -zoom 1-14,16/12 zoom levels 1 to 14 and 16, level 12 subdivised into higher levels
 
+order:
+  hilbert or zorder, tiles sorted by zoom level and position along the curve,
+    the tile set is loaded in memory, not available with -records
+
+timings:
+  -timings [<json_filename>] time spent in each phase of the command, displayed
+    with the report and saved in json file if a filename is given
+
 url template examples:
   OpenStreetMap: http://[abc].tile.openstreetmap.org/{z}/{x}/{y}.png
     may be abbreviated as OpenStreetMap
@@ -127,16 +160,20 @@ class ArgumentParser(argparse.ArgumentParser):
         xgroup.add_argument('-view',     metavar='db_name', action='store', dest='db_view'  , help='make an image from tiles')
         xgroup.add_argument('-server',   metavar='db_name', action='store', dest='db_server', help='connect to dabase through http')
         xgroup.add_argument('-stat',     metavar='db_name', action='store', dest='db_stat'  , help='statistics')
+        xgroup.add_argument('-migrate',  metavar='db_name', action='store', dest='db_migrate', help='convert database to latest format')
+        xgroup.add_argument('-rebuild',  metavar='db_name', action='store', dest='db_rebuild', help='rebuild statistics of database')
+        xgroup.add_argument('-pack',     metavar='db_name', action='store', dest='db_pack',  help='compact database')
 
         agroup = self.add_argument_group('Database properties')
         if sqlite3_available:
-            db_ids  = ('maverick', 'folder', 'rmaps', 'kahelo')
+            db_ids  = ('maverick', 'folder', 'rmaps', 'kahelo', 'mbtiles', 'bundle')
         else:
-            db_ids  = ('maverick', 'folder')
+            db_ids  = ('maverick', 'folder', 'bundle')
         img_ids = ('png', 'jpg', 'server')
         agroup.add_argument('-db_format'   , action='store', dest='db_format', choices=db_ids)
         agroup.add_argument('-tile_format' , action='store', dest='tile_format', choices=img_ids)
         agroup.add_argument('-url_template', action='store', dest='url_template', help='url template for tile server')
+        agroup.add_argument('-dedup'       , action='store', dest='dedup', choices=('on', 'off'), help='store identical tiles once')
 
         agroup = self.add_argument_group('Tile database source and destination')
         agroup.add_argument('-source'     , metavar='db_name', action='store', dest='db_source', help='source database')
@@ -151,13 +188,18 @@ class ArgumentParser(argparse.ArgumentParser):
         xgroup.add_argument('-project' , action='store',      dest='project',     help='project filename')
         xgroup.add_argument('-records' , action='store_true', dest='db_tiles',    help='tiles from database')
         xgroup.add_argument('-tiles'   , action='store',      dest='coord_tiles', help='tile coordinates')
+        xgroup.add_argument('-retry_failed', action='store_true', dest='failed_tiles', help='tiles from failure log')
         agroup.add_argument('-zoom'    , action='store',      dest='zoom',        help='zoom 0-%d' % MAXZOOM)
         agroup.add_argument('-radius'  , action='store',      dest='radius',      help='include disk radius in km')
         agroup.add_argument('-inside'  , action='store_true', dest='inside',      help='limit tilesets to intersection with database')
 
         agroup = self.add_argument_group('Other parameters')
         agroup.add_argument('-force'   , action='store_true', dest='force_insert', help='force insertion into database')
+        agroup.add_argument('-resume'  , action='store_true', dest='resume',      help='resume interrupted insertion')
+        agroup.add_argument('-order'   , action='store',      dest='order',       help='tile order', choices=('hilbert', 'zorder'))
         agroup.add_argument('-image'   , action='store',      dest='image',       help='name of output image')
+        agroup.add_argument('-timings' , action='store',      dest='timings',     help='time spent in each phase, optionally saved as json',
+                            nargs='?', const='', metavar='json_filename')
 
     def error(self, message):
         error(message)
@@ -183,7 +225,9 @@ class ArgumentParser(argparse.ArgumentParser):
                            options.db_insert   or options.db_import or
                            options.db_export   or options.db_delete or
                            options.db_view     or options.db_stat   or
-                           options.db_server   or None)
+                           options.db_server   or options.db_migrate or
+                           options.db_rebuild  or options.db_pack   or
+                           None)
 
         # expand url aliases
         if options.url_template == 'OpenStreetMap':
@@ -191,8 +235,9 @@ class ArgumentParser(argparse.ArgumentParser):
         if options.url_template == 'MapQuest':
             options.url_template = r'http://otile[1234].mqcdn.com/tiles/1.0.0/osm/{z}/{x}/{y}.jpg'
 
-        # nothing more to do for -describe or -server
-        if options.db_describe or options.db_server:
+        # nothing more to do for -describe, -server, -migrate, -rebuild or -pack
+        if (options.db_describe or options.db_server or options.db_migrate or
+            options.db_rebuild or options.db_pack):
             return options
 
         complete_source(options)
@@ -214,6 +259,8 @@ def complete_source(options):
         options.tile_generator, options.tile_source = db_tiles_generator, None
     elif options.coord_tiles:
         options.tile_generator, options.tile_source = coord_tiles_generator, options.coord_tiles
+    elif getattr(options, 'failed_tiles', False):
+        options.tile_generator, options.tile_source = failed_tiles_generator, None
     else:
         error('source is missing ')
 
@@ -228,7 +275,7 @@ def complete_source(options):
     if options.zoom is None:
         if options.project:
             options.zoom = list(range(MAXZOOM + 1))
-        elif options.db_tiles:
+        elif options.db_tiles or getattr(options, 'failed_tiles', False):
             options.zoom = list(range(MAXZOOM + 1))
         else:
             error('zoom must be given')
@@ -319,12 +366,31 @@ DEFAULTS = \
 [database]
 tile_validity = 3650                    ; number of days, 0 to ignore
 commit_period = 100
+pack_threshold = 0.1                    ; free page ratio of sqlite databases reclaimed after deleting
+pack_pages = 10000                      ; free pages reclaimed at most after deleting, 0 for all
+scan_threads = 1                        ; threads listing folder databases, 1 for sequential
+
+[sqlite]
+; empty values keep sqlite defaults
+journal_mode =                          ; DELETE, TRUNCATE, PERSIST, MEMORY, WAL or OFF
+synchronous =                           ; OFF, NORMAL, FULL or EXTRA
+mmap_size =                             ; bytes, 0 for no memory mapping
+cache_size =                            ; pages, or kilobytes if negative
+page_size =                             ; bytes, power of 2, for new databases
+temp_store =                            ; DEFAULT, FILE or MEMORY
 
 [insert]
-request_delay = 0.05                    ; seconds
+max_rate = 20                           ; requests per second, 0 for no limit
+host_max_rate = 10                      ; requests per second for each host, 0 for no limit
 timeout = 3                             ; seconds
 number_of_attempts = 3
+backoff_delay = 0.5                     ; seconds, doubled after each failed attempt
+backoff_max = 30                        ; seconds
+retry_rounds = 2                        ; retries of failed tiles at end of session
+retry_delay = 10                        ; seconds, doubled after each round
 session_max = 1000000
+workers = 1                             ; parallel downloads, 1 for sequential
+host_connections = 2                    ; parallel downloads per server host
 
 [import/export]
 draw_tile_limits = False                ; True or False
@@ -376,6 +442,14 @@ class KaheloConfigParser (configparser.ConfigParser):
     def error(self, section, entry):
         error('missing or incorrect config value: [%s]%s' % (section, entry))
 
+    def read_defaults(self, defaults):
+        # default values, overridden by the configuration files read next.
+        # Files written by previous versions lack the keys added since.
+        if sys.version_info < (3,):
+            self.readfp(StringIO.StringIO(defaults))
+        else:
+            self.read_string(defaults)
+
     def getint(self, section, entry):
         try:
             return configparser.ConfigParser.getint(self, section, entry)
@@ -450,6 +524,7 @@ def setconfig(section, key, value):
 def getconfig(options, config_filename, advanced_config_filename):
     class SubOptions: pass
     options.database = SubOptions()
+    options.sqlite   = SubOptions()
     options.insert   = SubOptions()
     options.Import   = SubOptions() # import is reserved
     options.view     = SubOptions()
@@ -458,17 +533,40 @@ def getconfig(options, config_filename, advanced_config_filename):
     options.Tracks   = SubOptions() # tracks is used for tileset
 
     config = KaheloConfigParser()
+    config.read_defaults(DEFAULTS)
+    config.read_defaults(DEFAULTS_ADVANCED)
     config.read(config_filename)
 
     # [database]
     options.database.tile_validity = config.getint('database', 'tile_validity')
     options.database.commit_period = config.getint('database', 'commit_period')
+    options.database.pack_threshold = config.getfloat('database', 'pack_threshold')
+    options.database.pack_pages = config.getint('database', 'pack_pages')
+    options.database.scan_threads = config.getint('database', 'scan_threads')
+
+    # [sqlite]
+    for key, _ in SQLITE_PRAGMAS:
+        value = config.get('sqlite', key)
+        setattr(options.sqlite, key, check_pragma(key, value, config_filename))
 
     # [insert]
-    options.insert.request_delay = config.getfloat('insert', 'request_delay')
+    options.insert.max_rate = config.getfloat('insert', 'max_rate')
+    options.insert.host_max_rate = config.getfloat('insert', 'host_max_rate')
+    previous = KaheloConfigParser()
+    previous.read(config_filename)
+    if previous.has_option('insert', 'request_delay') and not previous.has_option('insert', 'max_rate'):
+        # one request every request_delay seconds in previous versions
+        request_delay = config.getfloat('insert', 'request_delay')
+        options.insert.max_rate = 1.0 / request_delay if request_delay > 0 else 0
     options.insert.timeout = config.getfloat('insert', 'timeout')
     options.insert.number_of_attempts = config.getint('insert', 'number_of_attempts')
+    options.insert.backoff_delay = config.getfloat('insert', 'backoff_delay')
+    options.insert.backoff_max = config.getfloat('insert', 'backoff_max')
+    options.insert.retry_rounds = config.getint('insert', 'retry_rounds')
+    options.insert.retry_delay = config.getfloat('insert', 'retry_delay')
     options.insert.session_max = config.getint('insert', 'session_max')
+    options.insert.workers = config.getint('insert', 'workers')
+    options.insert.host_connections = config.getint('insert', 'host_connections')
 
     # [import/export]
     options.Import.draw_tile_limits = config.getboolean('import/export', 'draw_tile_limits')
@@ -552,6 +650,12 @@ def apply_command(options):
         do_server(options.db_name, options)
     elif options.db_stat:
         do_statistics(options.db_name, options)
+    elif options.db_migrate:
+        do_migrate(options.db_name, options)
+    elif options.db_rebuild:
+        do_rebuild(options.db_name, options)
+    elif options.db_pack:
+        do_pack(options.db_name, options)
     else:
         error('no command given')
 
@@ -648,6 +752,14 @@ def tile_hdistance_tu(x, y, zoom, d):
 
 # -- Tile utilities ----------------------------------------------------------
 
+def union_box(box1, box2):
+    # None stands for a whole zoom level
+    if box1 is None or box2 is None:
+        return None
+    else:
+        return (min(box1[0], box2[0]), min(box1[1], box2[1]),
+                max(box1[2], box2[2]), max(box1[3], box2[3]))
+
 def binding_box(tiles):
     xmin = 1000000000
     xmax = 0
@@ -913,14 +1025,18 @@ def track_points_project(project_filename, zoom, options):
 # - iterator (possibly yield generator)
 # - precalculated full size (taking into account tile subdivision)
 
+# - binding box of tiles for each zoom level when known (None for the whole
+#   level), used to prefetch tiles from databases
+
 class TileSet:
-    def __init__(self, gen=None, size=0):
+    def __init__(self, gen=None, size=0, boxes=None):
         if gen is None:
             self.gen = itertools.chain()
             self.size_ = 0
         else:
             self.gen = gen
             self.size_ = size
+        self.boxes = dict() if boxes is None else boxes
 
     def __iter__(self):
         return self.gen
@@ -931,6 +1047,11 @@ class TileSet:
     def extend(self, tileset):
         self.gen = itertools.chain(self.gen, tileset.gen)
         self.size_ += tileset.size_
+        for zoom, box in tileset.boxes.items():
+            if zoom in self.boxes:
+                self.boxes[zoom] = union_box(self.boxes[zoom], box)
+            else:
+                self.boxes[zoom] = box
 
     def binding_box(self):
         # has to copy the tile stream consumed by the call to binding_box
@@ -938,6 +1059,40 @@ class TileSet:
         self.gen = iter(tiles)
         return binding_box(tiles)
 
+    def order(self, order):
+        # sort tiles by zoom level then along a space filling curve to keep
+        # consecutive tiles close in databases and server caches
+        curve = TILE_ORDERS[order]
+        tiles = sorted(self.gen, key=lambda tile: (tile[2], curve(tile[0], tile[1], tile[2])))
+        self.gen = iter(tiles)
+
+def hilbert_index(x, y, zoom):
+    # position of tile along the Hilbert curve covering the zoom level
+    n = 2 ** zoom
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s //= 2
+    return d
+
+def morton_index(x, y, zoom):
+    # position of tile along the Z-order curve, interleaving bits of x and y
+    d = 0
+    for bit in range(zoom):
+        d |= ((x >> bit) & 1) << (2 * bit + 1)
+        d |= ((y >> bit) & 1) << (2 * bit)
+    return d
+
+TILE_ORDERS = {'hilbert': hilbert_index, 'zorder': morton_index}
+
 # subdivision generator
 # created with a list of (x, y)
 # when iterating, a tile at level current_zoom is subdivised at level
@@ -952,16 +1107,17 @@ def subdivise(tiles, zoom_current, zoom_target):
 
 # filtering with database and zoom
 
-def filter_tileset_with_db(tileset, db, zoom):
+def filter_tileset_with_db(tileset, db, zoom, box):
     """
     Return the list of tiles from tileset less the tiles absent from db. This is
     activated with the -inside parameter and useless with some commands (-insert
     and -import).
     Return a list because its needs to be scanned several times (starting with
     length).
+    Only the tiles of db inside box, binding the tileset, are read.
     """
 
-    db_tiles = db.list_tiles((zoom,))
+    db_tiles = db.list_tiles((zoom,), box)
     tileset = list(set(db_tiles).intersection(tileset))
     return tileset, len(tileset)
 
@@ -1052,18 +1208,32 @@ def tile_list_generate_level(options, generator, source, zoom, radius, db_source
         gen0 = generator(options, source, zoom, radius)
         gen = ((x, y, zoom) for x, y in gen0)
         size = len(gen0)
+        scale = 1
     else:
         # prepare tile coordinates for subdivision
         gen0 = generator(options, source, options.zoom_limit, radius)
         gen = subdivise(gen0, options.zoom_limit, zoom)
         size = len(gen0) * sqr(2 ** (zoom - options.zoom_limit))
+        scale = 2 ** (zoom - options.zoom_limit)
+
+    if gen0:
+        xmin, ymin, xmax, ymax = binding_box(gen0)
+        box = (xmin * scale, ymin * scale,
+               (xmax + 1) * scale - 1, (ymax + 1) * scale - 1)
+    else:
+        box = None
 
     if db_filter:
-        tileset, size = filter_tileset_with_db(gen, db_source, zoom)
+        if box is None:
+            tileset, size = [], 0
+        else:
+            tileset, size = filter_tileset_with_db(gen, db_source, zoom, box)
+        boxes = {zoom: binding_box(tileset)} if tileset else {}
     else:
         tileset, size = gen, size
+        boxes = {zoom: box} if box is not None else {}
 
-    return TileSet(tileset, size)
+    return TileSet(tileset, size, boxes)
 
 # tile set generator for -project
 
@@ -1086,7 +1256,8 @@ def tile_project_generator(options, project, zoom, radius, db_source, db_filter)
                     options_.radius = min(options_.radius, radius)
             ts2 = tileset(options_, db_source, db_filter)
             ts = set(ts).union(ts2)
-        tile_set.extend(TileSet(ts, len(ts)))
+        boxes = {z: binding_box(ts)} if ts else {}
+        tile_set.extend(TileSet(ts, len(ts), boxes))
 
     return tile_set
 
@@ -1120,9 +1291,27 @@ def db_tiles_generator(options, source, zooms, radius, db_source):
     if radius:
         error('radius is not used for -record tile set')
 
-    tiles = db_source.list_tiles(zooms)
-    size = len(tiles)
-    return TileSet(iter(tiles), size)
+    # tiles are streamed from the database, without binding boxes as
+    # prefetching whole zoom levels would load all tiles in memory
+    size = db_source.count_tiles(zooms)
+    tiles = db_source.iter_tiles(zooms)
+    return TileSet(tiles, size)
+
+# tile set generator for -retry_failed
+
+def failed_tiles_generator(options, source, zooms, radius, db_source):
+    if radius:
+        error('radius is not used for -retry_failed tile set')
+
+    log = FailureLog(options.db_name)
+    if not os.path.isfile(log.filename):
+        error('no failure log for database')
+
+    tiles = [(x, y, zoom) for x, y, zoom, url, last_error in log.read() if zoom in zooms]
+    boxes = dict()
+    for zoom in set(tile[2] for tile in tiles):
+        boxes[zoom] = binding_box([tile for tile in tiles if tile[2] == zoom])
+    return TileSet(iter(tiles), len(tiles), boxes)
 
 # tile set generator for -tiles
 
@@ -1145,11 +1334,13 @@ def coord_tiles_generator(options, source, zooms, radius, db_source, db_filter):
     size = (xmax - xmin + 1) * (ymax - ymin + 1)
 
     if options.inside:
-        tileset, size = filter_tileset_with_db(gen, db_source, zoom)
+        tileset, size = filter_tileset_with_db(gen, db_source, zoom, (xmin, ymin, xmax, ymax))
+        boxes = {zoom: binding_box(tileset)} if tileset else {}
     else:
         tileset, size = gen, size
+        boxes = {zoom: (xmin, ymin, xmax, ymax)}
 
-    return TileSet(iter(tileset), size)
+    return TileSet(iter(tileset), size, boxes)
 
 # tile set factory
 
@@ -1158,18 +1349,32 @@ def tileset(options, db, db_filter=False):
     try:
         if options.db_tiles:
             generator, source, zoom, radius = options_generate(options)
-            return db_tiles_generator(options, source, zoom, radius, db)
+            tile_set = db_tiles_generator(options, source, zoom, radius, db)
 
         elif options.coord_tiles:
             generator, source, zoom, radius = options_generate(options)
-            return coord_tiles_generator(options, source, zoom, radius, db, db_filter)
+            tile_set = coord_tiles_generator(options, source, zoom, radius, db, db_filter)
 
         elif options.project:
             generator, source, zoom, radius = options_generate(options)
-            return tile_project_generator(options, source, zoom, radius, db, db_filter)
+            tile_set = tile_project_generator(options, source, zoom, radius, db, db_filter)
+
+        elif getattr(options, 'failed_tiles', False):
+            generator, source, zoom, radius = options_generate(options)
+            tile_set = failed_tiles_generator(options, source, zoom, radius, db)
 
         else:
-            return tile_list_generator(options, db, db_filter)
+            tile_set = tile_list_generator(options, db, db_filter)
+
+        # order is not given for tile sets in projects. Sorting loads the
+        # tile set in memory, -records tile sets are streamed in database order
+        order = getattr(options, 'order', None)
+        if order is not None:
+            if options.db_tiles:
+                error('-order cannot be used with -records')
+            tile_set.order(order)
+
+        return tile_set
 
     except MemoryError:
         error('not enough memory, decrease zoom or contour area')
@@ -1178,11 +1383,43 @@ def tileset(options, db, db_filter=False):
 
 # -- Database classes --------------------------------------------------------
 
-class TileDatabase:
+class TilePresence:
+    # helper class, existence and date of the tiles of a zoom level inside a
+    # box (or the whole level if box is None), tiles are indexed with an
+    # integer key to save memory
+    def __init__(self, zoom, box, rows):
+        self.zoom = zoom
+        self.box = box
+        self.dates = dict(((x << zoom) | y, date) for x, y, date in rows)
+
+    def covers(self, x, y):
+        if self.box is None:
+            return True
+        else:
+            xmin, ymin, xmax, ymax = self.box
+            return xmin <= x <= xmax and ymin <= y <= ymax
+
+    def exists(self, x, y):
+        key = (x << self.zoom) | y
+        if key in self.dates:
+            return True, self.dates[key]
+        else:
+            return False, None
+
+    def update(self, x, y, date):
+        self.dates[(x << self.zoom) | y] = date
+
+    def delete(self, x, y):
+        self.dates.pop((x << self.zoom) | y, None)
+
+class TileDatabase(object):
     def __init__(self, fullname, tile_format, url_template):
         self.fullname = fullname
         self.__tile_format = tile_format
         self.__url_template = url_template
+        self.presence = dict()
+        # true when statistics of tiles stored are maintained
+        self.has_stats = False
 
     def tile_format(self):
         # provide the format of tiles stored in database
@@ -1217,6 +1454,32 @@ class TileDatabase:
         # return (True, date) if exists else (False, None)
         pass
 
+    def tile_dates(self, zoom, box=None):
+        # return an iterable of (x, y, date) for tiles of zoom level inside
+        # box (xmin, ymin, xmax, ymax), the whole level if box is None
+        pass
+
+    def prefetch(self, zoom, box=None):
+        # load existence and date of tiles inside box with one request, exists
+        # is then answered from memory for these tiles
+        self.presence[zoom] = TilePresence(zoom, box, self.tile_dates(zoom, box))
+
+    def prefetched(self, x, y, zoom):
+        # return presence information covering tile if prefetched, else None
+        presence = self.presence.get(zoom)
+        if presence is not None and presence.covers(x, y):
+            return presence
+        else:
+            return None
+
+    def presence_update(self, x, y, zoom, date):
+        if zoom in self.presence:
+            self.presence[zoom].update(x, y, date)
+
+    def presence_delete(self, x, y, zoom):
+        if zoom in self.presence:
+            self.presence[zoom].delete(x, y)
+
     def upper_tile(self, x, y, zoom):
         for z in range(zoom - 1, 0, -1):
             scale = 2 ** (zoom - z)
@@ -1238,50 +1501,418 @@ class TileDatabase:
     def update(self, date, x, y, zoom, tile):
         pass
 
-    def count_tiles(self, zoom):
+    def update_many(self, rows):
+        # rows of (date, x, y, zoom, tile), by default stored one at a time
+        for date, x, y, zoom, tile in rows:
+            self.update(date, x, y, zoom, tile)
+
+    def touch(self, date, x, y, zoom):
+        # set the date of an existing tile
+        pass
+
+    def validators(self, x, y, zoom):
+        # return http validators (etag, last_modified) of tile, None if unknown
+        return None, None
+
+    def update_validators(self, x, y, zoom, etag, last_modified):
+        pass
+
+    def count_tiles(self, zooms, box=None):
+        # number of tiles in zoom levels, limited to tiles inside box
+        # (xmin, ymin, xmax, ymax) if given
+        pass
+
+    def list_tiles(self, zooms, box=None):
+        # list of (x, y, zoom) in zoom levels, limited to tiles inside box if
+        # given
         pass
 
-    def list_tiles(self, zoom):
+    def iter_tiles(self, zooms, box=None):
+        # same as list_tiles without storing all tiles, by default one zoom
+        # level at a time
+        for zoom in zooms:
+            for tile in self.list_tiles((zoom,), box):
+                yield tile
+
+    def dedup_stats(self):
+        # return (number of tiles, number of images stored) for databases
+        # able to share identical images, None otherwise
+        return None
+
+    def zoom_stats(self):
+        # return a dictionary giving for each zoom level stored (count, bytes,
+        # size_min, size_max, date_min, date_max, xmin, ymin, xmax, ymax) of
+        # tiles, None if statistics are not maintained
+        return None
+
+    def stats_count(self, zooms):
+        # number of tiles in zoom levels from statistics
+        stats = self.zoom_stats()
+        return sum(stats[zoom][0] for zoom in zooms if zoom in stats)
+
+    def rebuild_stats(self):
+        # compute statistics from the tiles stored and maintain them
         pass
 
     def commit(self):
         pass
 
     def pack(self):
+        # full compaction of database
         pass
 
+    def reclaim(self, threshold, pages):
+        # release space after deleting tiles, by default with a full pack.
+        # threshold and pages bound the work for databases able to reclaim
+        # space incrementally
+        self.pack()
+
     def close(self):
         pass
 
-class SqliteDatabase(TileDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        TileDatabase.__init__(self, db_name, tile_format, url_template)
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+# statistics of tiles stored, for each zoom level a list of count, bytes, size
+# min and max, date min and max, xmin, ymin, xmax, ymax. Minimum and maximum
+# values are not reduced when deleting tiles, rebuilding statistics does.
+
+def stats_add(stats, zoom, x, y, date, size):
+    s = stats.get(zoom)
+    if s is None:
+        stats[zoom] = [1, size, size, size, date, date, x, y, x, y]
+    else:
+        s[0] += 1
+        s[1] += size
+        s[2:4] = min(s[2], size), max(s[3], size)
+        stats_touch(stats, zoom, date)
+        s[6:10] = min(s[6], x), min(s[7], y), max(s[8], x), max(s[9], y)
+
+def stats_touch(stats, zoom, date):
+    s = stats.get(zoom)
+    if s is not None and date is not None:
+        s[4] = date if s[4] is None else min(s[4], date)
+        s[5] = date if s[5] is None else max(s[5], date)
+
+def stats_remove(stats, zoom, size):
+    # False if the tile was not counted, statistics are then no longer valid
+    s = stats.get(zoom)
+    if s is None or s[0] <= 0:
+        return False
+    s[0] -= 1
+    s[1] -= size
+    if s[0] <= 0:
+        del stats[zoom]
+    return True
+
+# sqlite pragmas set from configuration and database properties, in the order
+# they are applied, with their accepted values or None for integers
+SQLITE_PRAGMAS = (
+    ('page_size', None),
+    ('journal_mode', ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')),
+    ('synchronous', ('OFF', 'NORMAL', 'FULL', 'EXTRA')),
+    ('cache_size', None),
+    ('mmap_size', None),
+    ('temp_store', ('DEFAULT', 'FILE', 'MEMORY')))
+
+def check_pragma(key, value, filename):
+    # return value to use in pragma statement, empty string to keep default
+    choices = dict(SQLITE_PRAGMAS)
+    if key not in choices:
+        error('unknown sqlite parameter %s in %s' % (key, filename))
+    value = '' if value is None else value.strip()
+    if value == '':
+        return value
+    elif choices[key] is None:
+        try:
+            return str(int(value))
+        except ValueError:
+            pass
+    elif value.upper() in choices[key]:
+        return value.upper()
+    error('incorrect value for sqlite parameter %s in %s' % (key, filename))
+
+def sqlite_pragmas(options, properties):
+    # configuration values, overridden by the [sqlite] section of the
+    # database properties
+    pragmas = dict()
+    if options is not None:
+        for key, _ in SQLITE_PRAGMAS:
+            pragmas[key] = getattr(options.sqlite, key)
+    for key, value in properties.get_section('sqlite').items():
+        pragmas[key] = check_pragma(key, value, properties.filename)
+    return pragmas
+
+def box_condition(box, x_column, y_column):
+    # sql condition and arguments limiting tiles to box, nothing if box is None
+    if box is None:
+        return '', ()
+    else:
+        xmin, ymin, xmax, ymax = box
+        return (' AND %s BETWEEN ? AND ? AND %s BETWEEN ? AND ?' % (x_column, y_column),
+                (xmin, xmax, ymin, ymax))
+
+# statistics of sqlite databases are kept in a table maintained by triggers on
+# the tile table. Expressions of zoom, x, y, date and size of tiles are given
+# by each format in STATS_COLUMNS, for rows of the tile table named {row}.
+
+STATS_TABLE = (
+    'CREATE TABLE tile_stats (zoom integer PRIMARY KEY, count integer, bytes integer, '
+    'size_min integer, size_max integer, date_min timestamp, date_max timestamp, '
+    'xmin integer, ymin integer, xmax integer, ymax integer)')
+
+STATS_REBUILD = (
+    'INSERT INTO tile_stats SELECT {zoom}, COUNT(*), SUM({size}), MIN({size}), MAX({size}), '
+    'MIN({date}), MAX({date}), MIN({x}), MIN({y}), MAX({x}), MAX({y}) FROM tiles GROUP BY {zoom}')
+
+# the row of a zoom level is created by a conditional insert as the conflict
+# clause of a replacing insert would apply to the trigger
+STATS_INSERT_TRIGGER = """
+CREATE TRIGGER tile_stats_insert AFTER INSERT ON tiles BEGIN
+    INSERT INTO tile_stats (zoom, count, bytes) SELECT {zoom}, 0, 0
+        WHERE NOT EXISTS (SELECT 1 FROM tile_stats WHERE zoom = {zoom});
+    UPDATE tile_stats SET count = count + 1, bytes = bytes + {size},
+        size_min = MIN(IFNULL(size_min, {size}), {size}), size_max = MAX(IFNULL(size_max, {size}), {size}),
+        date_min = MIN(IFNULL(date_min, {date}), {date}), date_max = MAX(IFNULL(date_max, {date}), {date}),
+        xmin = MIN(IFNULL(xmin, {x}), {x}), ymin = MIN(IFNULL(ymin, {y}), {y}),
+        xmax = MAX(IFNULL(xmax, {x}), {x}), ymax = MAX(IFNULL(ymax, {y}), {y})
+        WHERE zoom = {zoom};
+END"""
+
+STATS_DELETE_TRIGGER = """
+CREATE TRIGGER tile_stats_delete AFTER DELETE ON tiles BEGIN
+    UPDATE tile_stats SET count = count - 1, bytes = bytes - {size} WHERE zoom = {zoom};
+    DELETE FROM tile_stats WHERE zoom = {zoom} AND count <= 0;
+END"""
+
+STATS_TOUCH_TRIGGER = """
+CREATE TRIGGER tile_stats_touch AFTER UPDATE OF date ON tiles BEGIN
+    UPDATE tile_stats SET date_min = MIN(IFNULL(date_min, {date}), {date}),
+        date_max = MAX(IFNULL(date_max, {date}), {date}) WHERE zoom = {zoom};
+END"""
+
+# number of rows read at a time when iterating over tiles
+ITER_PAGE_SIZE = 10000
+
+# pragmas applying to each connection, the others are set by the writer
+READER_PRAGMAS = ('mmap_size', 'cache_size', 'temp_store')
+
+class SqliteConnectionPool:
+    """
+    Connections to a sqlite database shared between threads. The thread
+    opening the database owns the writer connection and is the only one to
+    update the database. Other threads read through their own read only
+    connection, opened at first use, and see committed changes only. The
+    connections of ended threads are closed when opening a new one.
+    """
+    def __init__(self, db_name, pragmas):
+        self.db_name = db_name
+        self.pragmas = pragmas
+        self.owner = threading.current_thread()
+        self.writer = self.connect()
+        self.local = threading.local()
+        self.readers = []  # (thread, connection)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # connections may be closed by another thread than their own
+        conn = sqlite3.connect(self.db_name, check_same_thread=False)
         if sys.version_info < (3,):
-            self.conn.text_factory = str
+            conn.text_factory = str
         else:
-            self.conn.text_factory = bytes
-        self.cursor = self.conn.cursor()
+            conn.text_factory = bytes
+        return conn, conn.cursor()
+
+    def connection(self):
+        # return (connection, cursor) of the calling thread
+        if threading.current_thread() is self.owner:
+            return self.writer
+        reader = getattr(self.local, 'reader', None)
+        if reader is None:
+            reader = self.connect()
+            for key in READER_PRAGMAS:
+                if self.pragmas.get(key):
+                    reader[1].execute('PRAGMA %s = %s' % (key, self.pragmas[key]))
+            reader[1].execute('PRAGMA query_only = ON')
+            self.local.reader = reader
+            with self.lock:
+                for thread, conn in self.readers:
+                    if not thread.is_alive():
+                        conn.close()
+                self.readers = [(thread, conn) for thread, conn in self.readers if thread.is_alive()]
+                self.readers.append((threading.current_thread(), reader[0]))
+        return reader
+
+    def close(self):
+        with self.lock:
+            for _, conn in self.readers:
+                conn.close()
+            self.readers = []
+        self.writer[0].close()
+
+class SqliteDatabase(TileDatabase):
+    def __init__(self, db_name, tile_format, url_template, pragmas=None):
+        TileDatabase.__init__(self, db_name, tile_format, url_template)
+        new = not os.path.isfile(db_name) or os.path.getsize(db_name) == 0
+        self.connections = SqliteConnectionPool(db_name, pragmas or dict())
+        self.set_pragmas(pragmas or dict(), new)
+        # replacing inserts fire delete triggers maintaining statistics
+        self.execute('PRAGMA recursive_triggers = ON')
+
+    def set_pragmas(self, pragmas, new):
+        # page_size and auto_vacuum have to be set before creating tables and
+        # switching to WAL mode, free pages of new databases are released by
+        # reclaim
+        for key, _ in SQLITE_PRAGMAS:
+            if pragmas.get(key):
+                self.execute('PRAGMA %s = %s' % (key, pragmas[key]))
+            if key == 'page_size' and new:
+                self.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    @property
+    def conn(self):
+        # connection of the calling thread
+        return self.connections.connection()[0]
+
+    @property
+    def cursor(self):
+        # cursor of the calling thread
+        return self.connections.connection()[1]
 
     def execute(self, request, *args):
         self.cursor.execute(request, args)
 
+    def iter_pages(self, request, *args):
+        # generate the rows of request by pages of rowids, the request selects
+        # rowid first and ends with a condition. Rows are read with their own
+        # cursor and without keeping a statement open between pages, so the
+        # database may be updated while iterating. Rows inserted or replaced
+        # after the first page have greater rowids and are ignored, tiles
+        # replaced by another connection before being read are then missed.
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT MAX(rowid) FROM tiles')
+        last_rowid = cursor.fetchone()[0]
+        rowid = -1
+        while last_rowid is not None:
+            cursor.execute(request + ' AND rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?',
+                           args + (rowid, last_rowid, ITER_PAGE_SIZE))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row[1:]
+            rowid = rows[-1][0]
+
+    def has_index(self, name):
+        self.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?", name)
+        return self.cursor.fetchone() is not None
+
+    def create_unique_index(self, name, table, columns):
+        # duplicated tiles may have been stored by previous versions, only the
+        # last inserted is kept
+        self.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT MAX(rowid) FROM %s GROUP BY %s)'
+                     % (table, table, columns))
+        self.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table, columns))
+
+    def table_type(self, name):
+        # 'table' or 'view', None if name is not defined
+        self.execute("SELECT type FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", name)
+        row = self.cursor.fetchone()
+        return None if row is None else decode_text(row[0])
+
+    def has_table(self, name):
+        return self.table_type(name) is not None
+
+    def init_stats(self, new):
+        # statistics are maintained from the creation of the database, or
+        # after rebuilding them for databases created without
+        if new:
+            self.rebuild_stats()
+        else:
+            self.has_stats = self.has_table('tile_stats')
+
+    def stats_columns(self, row):
+        return dict((key, value.format(row=row)) for key, value in self.STATS_COLUMNS.items())
+
+    def drop_stats(self):
+        for name in ('tile_stats_insert', 'tile_stats_delete', 'tile_stats_touch'):
+            self.execute('DROP TRIGGER IF EXISTS %s' % name)
+        self.execute('DROP TABLE IF EXISTS tile_stats')
+        self.has_stats = False
+
+    def rebuild_stats(self):
+        self.drop_stats()
+        self.execute(STATS_TABLE)
+        self.execute(STATS_REBUILD.format(**self.stats_columns('tiles.')))
+        self.execute(STATS_INSERT_TRIGGER.format(**self.stats_columns('NEW.')))
+        self.execute(STATS_DELETE_TRIGGER.format(**self.stats_columns('OLD.')))
+        if self.STATS_COLUMNS['date'] != 'NULL':
+            self.execute(STATS_TOUCH_TRIGGER.format(**self.stats_columns('NEW.')))
+        self.commit()
+        self.has_stats = True
+
+    def zoom_stats(self):
+        if not self.has_stats:
+            return None
+        self.execute('SELECT * FROM tile_stats')
+        return dict((row[0], row[1:]) for row in self.cursor.fetchall())
+
+    def update(self, date, x, y, zoom, tile):
+        self.update_many([(date, x, y, zoom, tile)])
+
     def commit(self):
         self.conn.commit()
 
+    def pragma(self, name):
+        self.execute('PRAGMA %s' % name)
+        return self.cursor.fetchone()[0]
+
     def pack(self):
-        self.execute('vacuum')
+        # databases created without incremental vacuum are converted
+        self.commit()
+        self.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.execute('VACUUM')
+
+    def reclaim(self, threshold, pages):
+        # release free pages when exceeding threshold ratio of database pages,
+        # at most pages if not 0, return the number of pages released. Space
+        # of databases without incremental vacuum is reclaimed by -pack.
+        self.commit()
+        if self.pragma('auto_vacuum') != 2:
+            return 0
+        free = self.pragma('freelist_count')
+        if free == 0 or free <= threshold * self.pragma('page_count'):
+            return 0
+        n = free if pages == 0 else min(free, pages)
+        # a page is released at each step of the statement, executescript
+        # steps until done where execute steps once
+        self.cursor.executescript('PRAGMA incremental_vacuum(%d)' % n)
+        return free - self.pragma('freelist_count')
 
     def close(self):
-        self.conn.close()
+        self.connections.close()
 
 class KaheloDatabase(SqliteDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        SqliteDatabase.__init__(self, db_name, tile_format, url_template)
+    # version 1 of kahelo format, tiles and blobs in a table indexed on tile
+    # coordinates, superseded by Kahelo2Database for new databases
+    VERSION = 1
+    STATS_COLUMNS = dict(zoom='{row}zoom', x='{row}x', y='{row}y', date='{row}date',
+                         size='length(CAST({row}tile AS blob))')
+
+    def __init__(self, db_name, tile_format, url_template, pragmas=None):
+        SqliteDatabase.__init__(self, db_name, tile_format, url_template, pragmas)
+        # unique index required by replacing inserts is created with the first
+        # tiles to store
+        self.has_unique_index = self.has_index('tile_unique_index')
+        new = not self.has_table('tiles')
+        self.create_tables()
+        self.commit()
+        self.init_stats(new)
+        # http validators table is created with the first validators to store
+        self.has_validators = self.has_table('validators')
+
+    def create_tables(self):
         self.execute('CREATE TABLE IF NOT EXISTS server (template text, format text)')
         self.execute('CREATE TABLE IF NOT EXISTS tiles (date timestamp, x integer, y integer, zoom integer, tile blob)')
-        self.execute('CREATE INDEX IF NOT EXISTS tile_index ON tiles (x, y, zoom)')
-        self.commit()
+        if not self.has_unique_index:
+            self.execute('CREATE INDEX IF NOT EXISTS tile_index ON tiles (x, y, zoom)')
 
     def __retrieve(self, x, y, zoom):
         # private, return the row including rowid,date
@@ -1294,9 +1925,17 @@ class KaheloDatabase(SqliteDatabase):
         return self.cursor.fetchone()
 
     def exists(self, x, y, zoom):
+        presence = self.prefetched(x, y, zoom)
+        if presence is not None:
+            return presence.exists(x, y)
         row = self.__retrieve(x, y, zoom)
         return (False, None) if row is None else (True, row[1])
 
+    def tile_dates(self, zoom, box=None):
+        condition, args = box_condition(box, 'x', 'y')
+        self.execute('SELECT x,y,date FROM tiles WHERE zoom = ?' + condition, zoom, *args)
+        return self.cursor.fetchall()
+
     def retrieve(self, x, y, zoom):
         row = self.__retrieve_full(x, y, zoom)
         if row is None:
@@ -1312,38 +1951,328 @@ class KaheloDatabase(SqliteDatabase):
         else:
             return (True, row[1], row[2])
 
-    def update(self, date, x, y, zoom, tile_buffer):
-        row = self.__retrieve(x, y, zoom)
-        if row is not None:
-            self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
-        if date is None:
-            date = int(math.trunc(time()))
-        self.execute("INSERT INTO tiles VALUES (?,?,?,?,?)", date, x, y, zoom, tile_buffer)
+    def update_many(self, rows):
+        if not self.has_unique_index:
+            self.create_unique_index('tile_unique_index', 'tiles', 'x, y, zoom')
+            # replaced by the unique index
+            self.execute('DROP INDEX IF EXISTS tile_index')
+            self.has_unique_index = True
+        now = int(math.trunc(time()))
+        rows = [(now if date is None else date, x, y, zoom, tile_buffer)
+                for date, x, y, zoom, tile_buffer in rows]
+        self.cursor.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?)", rows)
+        for date, x, y, zoom, _ in rows:
+            self.presence_update(x, y, zoom, date)
+
+    def touch(self, date, x, y, zoom):
+        self.execute("UPDATE tiles SET date = ? WHERE x = ? AND y = ? AND zoom = ?", date, x, y, zoom)
+        self.presence_update(x, y, zoom, date)
+
+    def validators(self, x, y, zoom):
+        if not self.has_validators:
+            return None, None
+        self.execute("SELECT etag,last_modified FROM validators WHERE x = ? AND y = ? AND zoom = ?", x, y, zoom)
+        row = self.cursor.fetchone()
+        if row is None:
+            return None, None
+        else:
+            return tuple(None if v is None else decode_text(v) for v in row)
+
+    def update_validators(self, x, y, zoom, etag, last_modified):
+        if etag is None and last_modified is None:
+            if self.has_validators:
+                self.execute("DELETE FROM validators WHERE x = ? AND y = ? AND zoom = ?", x, y, zoom)
+        else:
+            if not self.has_validators:
+                self.execute('CREATE TABLE IF NOT EXISTS validators (x integer, y integer, zoom integer, etag text, last_modified text)')
+                self.execute('CREATE UNIQUE INDEX IF NOT EXISTS validator_index ON validators (x, y, zoom)')
+                self.has_validators = True
+            self.execute("INSERT OR REPLACE INTO validators VALUES (?,?,?,?,?)", x, y, zoom, etag, last_modified)
 
     def delete(self, x, y, zoom):
         row = self.__retrieve(x, y, zoom)
         if row is not None:
             self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
+            if self.has_validators:
+                self.execute("DELETE FROM validators WHERE x = ? AND y = ? AND zoom = ?", x, y, zoom)
+        self.presence_delete(x, y, zoom)
         return True
 
-    def count_tiles(self, zooms):
+    def count_tiles(self, zooms, box=None):
+        if box is None and self.has_stats:
+            return self.stats_count(zooms)
+        condition, args = box_condition(box, 'x', 'y')
         R = 0
         for zoom in zooms:
-            self.execute('SELECT COUNT(*) FROM tiles WHERE zoom = ?', zoom)
+            self.execute('SELECT COUNT(*) FROM tiles WHERE zoom = ?' + condition, zoom, *args)
             r = self.cursor.fetchall()
             R += r[0][0]
         return R
 
-    def list_tiles(self, zooms):
+    def list_tiles(self, zooms, box=None):
+        condition, args = box_condition(box, 'x', 'y')
         R = []
         for zoom in zooms:
-            self.execute('SELECT x,y,zoom FROM tiles WHERE zoom = ?', zoom)
+            self.execute('SELECT x,y,zoom FROM tiles WHERE zoom = ?' + condition, zoom, *args)
             R.extend(self.cursor.fetchall())
         return R
 
+    def iter_tiles(self, zooms, box=None):
+        condition, args = box_condition(box, 'x', 'y')
+        for zoom in zooms:
+            for tile in self.iter_pages('SELECT rowid,x,y,zoom FROM tiles WHERE zoom = ?' + condition, zoom, *args):
+                yield tile
+
+    def migrate(self):
+        # convert in place to version 2 in a single transaction, return the
+        # number of tiles converted
+        self.commit()
+        self.conn.isolation_level = None
+        try:
+            self.execute('BEGIN')
+            # statistics are rebuilt for the new tile table
+            self.drop_stats()
+            self.execute('ALTER TABLE tiles RENAME TO tiles_v1')
+            self.execute('DROP INDEX IF EXISTS tile_index')
+            self.execute('DROP INDEX IF EXISTS tile_unique_index')
+            for request in KAHELO2_TABLES:
+                self.execute(request)
+            # blob ids are the former rowids, duplicated tiles are ignored
+            latest = 'SELECT MAX(rowid) FROM tiles_v1 GROUP BY x, y, zoom'
+            self.execute('INSERT INTO blobs (id, tile, refs) SELECT rowid, tile, 1 FROM tiles_v1 WHERE rowid IN (%s)' % latest)
+            self.execute('INSERT INTO tiles (zoom, x, y, date, tile_id) '
+                         'SELECT zoom, x, y, date, rowid FROM tiles_v1 WHERE rowid IN (%s)' % latest)
+            self.execute('SELECT COUNT(*) FROM tiles')
+            n = self.cursor.fetchone()[0]
+            self.execute('DROP TABLE tiles_v1')
+            self.execute('COMMIT')
+        except:
+            self.execute('ROLLBACK')
+            raise
+        finally:
+            self.conn.isolation_level = ''
+        return n
+
+KAHELO2_TABLES = (
+    'CREATE TABLE IF NOT EXISTS server (template text, format text)',
+    'CREATE TABLE IF NOT EXISTS tiles (zoom integer, x integer, y integer, date timestamp, tile_id integer, '
+    'PRIMARY KEY (zoom, x, y)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS blobs (id integer PRIMARY KEY, tile blob, hash blob, refs integer)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS blob_hash_index ON blobs (hash)',
+    'PRAGMA user_version = 2')
+
+class Kahelo2Database(KaheloDatabase):
+    """
+    Version 2 of kahelo format. Tiles are stored in a table without rowid
+    ordered by (zoom, x, y), the primary key giving the date without reading
+    other pages. Blobs are stored in a separate table with a reference count.
+    In dedup mode, identical images are stored once, found from their hash.
+    """
+    VERSION = 2
+    STATS_COLUMNS = dict(KaheloDatabase.STATS_COLUMNS,
+                         size='(SELECT length(CAST(tile AS blob)) FROM blobs WHERE id = {row}tile_id)')
+
+    def __init__(self, db_name, tile_format, url_template, pragmas=None, dedup=False):
+        KaheloDatabase.__init__(self, db_name, tile_format, url_template, pragmas)
+        self.dedup = dedup
+
+    def create_tables(self):
+        for request in KAHELO2_TABLES:
+            self.execute(request)
+
+    def exists(self, x, y, zoom):
+        presence = self.prefetched(x, y, zoom)
+        if presence is not None:
+            return presence.exists(x, y)
+        self.execute('SELECT date FROM tiles WHERE zoom = ? AND x = ? AND y = ?', zoom, x, y)
+        row = self.cursor.fetchone()
+        return (False, None) if row is None else (True, row[0])
+
+    def retrieve(self, x, y, zoom):
+        exists, date, tile_buffer = self.retrieve_buffer(x, y, zoom)
+        if not exists:
+            return (False, None, None)
+        else:
+            return (True, date, create_image_from_blob(tile_buffer))
+
+    def retrieve_buffer(self, x, y, zoom):
+        self.execute('SELECT tiles.date, blobs.tile FROM tiles JOIN blobs ON blobs.id = tiles.tile_id '
+                     'WHERE zoom = ? AND x = ? AND y = ?', zoom, x, y)
+        row = self.cursor.fetchone()
+        if row is None:
+            return (False, None, None)
+        else:
+            return (True, row[0], row[1])
+
+    def update_many(self, rows):
+        now = int(math.trunc(time()))
+        # one row for each tile, the last one given
+        tiles = dict()
+        for date, x, y, zoom, tile_buffer in rows:
+            tiles[(zoom, x, y)] = (now if date is None else date, tile_buffer)
+
+        # new blobs are referenced before releasing the replaced ones, an
+        # unchanged image is then kept in dedup mode
+        keys = list(tiles.keys())
+        replaced = self.blob_ids(keys)
+        blob_ids = self.store_blobs([tiles[key][1] for key in keys])
+        values = [key + (tiles[key][0], blob_id) for key, blob_id in zip(keys, blob_ids)]
+        self.cursor.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?)', values)
+        self.release_blobs(replaced)
+
+        for zoom, x, y, date, _ in values:
+            self.presence_update(x, y, zoom, date)
+
+    def batch_table(self, name, columns, rows):
+        # fill a temporary table with the rows of a batch, joined to other
+        # tables to handle the batch with one request
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS %s (%s)' % (name, ', '.join(columns)))
+        self.execute('DELETE FROM %s' % name)
+        self.cursor.executemany('INSERT INTO %s VALUES (%s)' % (name, ','.join('?' * len(columns))), rows)
+
+    def blob_ids(self, keys):
+        # return ids of blobs of existing tiles given as (zoom, x, y)
+        self.batch_table('batch_keys', ('zoom', 'x', 'y'), keys)
+        self.execute('SELECT tiles.tile_id FROM batch_keys JOIN tiles ON tiles.zoom = batch_keys.zoom '
+                     'AND tiles.x = batch_keys.x AND tiles.y = batch_keys.y')
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def store_blobs(self, buffers):
+        # return ids of blobs storing tile buffers, new blobs are inserted
+        # with one request. In dedup mode, an identical image already stored
+        # or repeated in buffers is referenced once more
+        self.execute('SELECT IFNULL(MAX(id), 0) FROM blobs')
+        next_id = self.cursor.fetchone()[0] + 1
+        if not self.dedup:
+            ids = list(range(next_id, next_id + len(buffers)))
+            self.cursor.executemany('INSERT INTO blobs (id, tile, hash, refs) VALUES (?,?,NULL,1)',
+                                    list(zip(ids, buffers)))
+            return ids
+
+        digests = [hashlib.sha1(tile_buffer).digest() for tile_buffer in buffers]
+        self.batch_table('batch_hashes', ('hash',), [(sqlite3.Binary(digest),) for digest in set(digests)])
+        self.execute('SELECT blobs.hash, blobs.id FROM batch_hashes JOIN blobs ON blobs.hash = batch_hashes.hash')
+        stored = dict((bytes(digest), blob_id) for digest, blob_id in self.cursor.fetchall())
+        ids = []
+        # references added to stored blobs, and new blobs as [id, tile, hash, refs]
+        refs = dict()
+        new = dict()
+        for digest, tile_buffer in zip(digests, buffers):
+            if digest in stored:
+                blob_id = stored[digest]
+                refs[blob_id] = refs.get(blob_id, 0) + 1
+            elif digest in new:
+                blob_id = new[digest][0]
+                new[digest][3] += 1
+            else:
+                blob_id = next_id
+                next_id += 1
+                new[digest] = [blob_id, tile_buffer, sqlite3.Binary(digest), 1]
+            ids.append(blob_id)
+        self.cursor.executemany('UPDATE blobs SET refs = refs + ? WHERE id = ?',
+                                [(count, blob_id) for blob_id, count in refs.items()])
+        self.cursor.executemany('INSERT INTO blobs (id, tile, hash, refs) VALUES (?,?,?,?)',
+                                sorted((tuple(row) for row in new.values()), key=lambda row: row[0]))
+        return ids
+
+    def release_blobs(self, ids):
+        # blobs are removed when no more referenced
+        ids = [(blob_id,) for blob_id in ids]
+        self.cursor.executemany('UPDATE blobs SET refs = refs - 1 WHERE id = ?', ids)
+        self.cursor.executemany('DELETE FROM blobs WHERE id = ? AND refs <= 0', ids)
+
+    def deduplicate(self):
+        # hash images stored without dedup and share identical ones, return
+        # the number of blobs removed
+        self.execute('SELECT id FROM blobs WHERE hash IS NULL')
+        ids = [row[0] for row in self.cursor.fetchall()]
+        duplicates = []
+        refs = dict()
+        for blob_id in ids:
+            self.execute('SELECT tile, refs FROM blobs WHERE id = ?', blob_id)
+            tile_buffer, count = self.cursor.fetchone()
+            digest = sqlite3.Binary(hashlib.sha1(tile_buffer).digest())
+            self.execute('SELECT id FROM blobs WHERE hash = ?', digest)
+            row = self.cursor.fetchone()
+            if row is None:
+                self.execute('UPDATE blobs SET hash = ? WHERE id = ?', digest, blob_id)
+            else:
+                duplicates.append((blob_id, row[0]))
+                refs[row[0]] = refs.get(row[0], 0) + count
+
+        # tiles are redirected with one scan of the tile table
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS blob_map (id integer PRIMARY KEY, shared integer)')
+        self.cursor.executemany('INSERT INTO blob_map VALUES (?,?)', duplicates)
+        self.execute('UPDATE tiles SET tile_id = (SELECT shared FROM blob_map WHERE blob_map.id = tiles.tile_id) '
+                     'WHERE tile_id IN (SELECT id FROM blob_map)')
+        self.cursor.executemany('UPDATE blobs SET refs = refs + ? WHERE id = ?',
+                                [(count, blob_id) for blob_id, count in refs.items()])
+        self.execute('DELETE FROM blobs WHERE id IN (SELECT id FROM blob_map)')
+        self.execute('DROP TABLE blob_map')
+        self.commit()
+        return len(duplicates)
+
+    def dedup_stats(self):
+        self.execute('SELECT COUNT(*) FROM tiles')
+        tiles = self.cursor.fetchone()[0]
+        self.execute('SELECT COUNT(*) FROM blobs')
+        return tiles, self.cursor.fetchone()[0]
+
+    def iter_tiles(self, zooms, box=None):
+        # pages follow the primary key, replaced tiles keep their place
+        condition, args = box_condition(box, 'x', 'y')
+        cursor = self.conn.cursor()
+        for zoom in zooms:
+            x, y = -1, -1
+            while True:
+                cursor.execute('SELECT x,y FROM tiles WHERE zoom = ? AND (x > ? OR x = ? AND y > ?)' + condition +
+                               ' ORDER BY x, y LIMIT ?', (zoom, x, x, y) + args + (ITER_PAGE_SIZE,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0], row[1], zoom
+                x, y = rows[-1]
+
+    def touch(self, date, x, y, zoom):
+        self.execute('UPDATE tiles SET date = ? WHERE zoom = ? AND x = ? AND y = ?', date, zoom, x, y)
+        self.presence_update(x, y, zoom, date)
+
+    def delete(self, x, y, zoom):
+        self.execute('SELECT tile_id FROM tiles WHERE zoom = ? AND x = ? AND y = ?', zoom, x, y)
+        replaced = [row[0] for row in self.cursor.fetchall()]
+        self.execute('DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?', zoom, x, y)
+        self.release_blobs(replaced)
+        if self.has_validators:
+            self.execute("DELETE FROM validators WHERE x = ? AND y = ? AND zoom = ?", x, y, zoom)
+        self.presence_delete(x, y, zoom)
+        return True
+
+def kahelo_version(db_name):
+    # return the version of the kahelo format of an existing database, the
+    # latest version for a new one
+    if not os.path.isfile(db_name) or os.path.getsize(db_name) == 0:
+        return Kahelo2Database.VERSION
+    conn = sqlite3.connect(db_name)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        has_tiles = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tiles'").fetchone()
+    finally:
+        conn.close()
+    if version == 0 and has_tiles:
+        return KaheloDatabase.VERSION
+    elif version == 0:
+        return Kahelo2Database.VERSION
+    else:
+        return version
+
 class RmapsDatabase(SqliteDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        SqliteDatabase.__init__(self, db_name, tile_format, url_template)
+    STATS_COLUMNS = dict(zoom='(17 - {row}z)', x='{row}x', y='{row}y', date='NULL',
+                         size='length(CAST({row}image AS blob))')
+
+    def __init__(self, db_name, tile_format, url_template, pragmas=None):
+        SqliteDatabase.__init__(self, db_name, tile_format, url_template, pragmas)
+        new = not self.has_table('tiles')
         self.execute('CREATE TABLE IF NOT EXISTS android_metadata (locale text)')
         self.execute('CREATE TABLE IF NOT EXISTS tiles (x integer, y integer, z integer, s integer, image blob)')
         self.execute('CREATE INDEX IF NOT EXISTS IND ON tiles (x, y, z, s)')
@@ -1355,6 +2284,10 @@ class RmapsDatabase(SqliteDatabase):
             self.execute("INSERT INTO android_metadata VALUES (?)", '',)
             self.execute("INSERT INTO info VALUES (?,?)", 1, 17)
         self.commit()
+        self.init_stats(new)
+        # created with the first tiles to store, IND is kept as created by
+        # RMaps
+        self.has_unique_index = self.has_index('tile_unique_index')
 
     def __retrieve(self, x, y, zoom):
         # private, return the row including rowid
@@ -1367,9 +2300,17 @@ class RmapsDatabase(SqliteDatabase):
         return self.cursor.fetchone()
 
     def exists(self, x, y, zoom):
+        presence = self.prefetched(x, y, zoom)
+        if presence is not None:
+            return presence.exists(x, y)
         row = self.__retrieve(x, y, zoom)
         return (row is not None), None
 
+    def tile_dates(self, zoom, box=None):
+        condition, args = box_condition(box, 'x', 'y')
+        self.execute('SELECT x,y FROM tiles WHERE z = ?' + condition, 17 - zoom, *args)
+        return [(x, y, None) for x, y in self.cursor.fetchall()]
+
     def retrieve(self, x, y, zoom):
         row = self.__retrieve_full(x, y, zoom)
         if row is None:
@@ -1385,182 +2326,1091 @@ class RmapsDatabase(SqliteDatabase):
         else:
             return True, None, row[1]
 
-    def update(self, date, x, y, zoom, tile):
-        row = self.__retrieve(x, y, zoom)
-        if row is not None:
-            self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
-        self.execute("INSERT INTO tiles VALUES (?,?,?,?,?)", x, y, 17 - zoom, 0, tile)
+    def update_many(self, rows):
+        if not self.has_unique_index:
+            self.create_unique_index('tile_unique_index', 'tiles', 'x, y, z, s')
+            self.has_unique_index = True
+        self.cursor.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?)",
+                                [(x, y, 17 - zoom, 0, tile) for _, x, y, zoom, tile in rows])
+        for _, x, y, zoom, _ in rows:
+            self.presence_update(x, y, zoom, None)
 
     def delete(self, x, y, zoom):
         row = self.__retrieve(x, y, zoom)
         if row is not None:
             self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
+        self.presence_delete(x, y, zoom)
         return True
 
-    def count_tiles(self, zooms):
+    def count_tiles(self, zooms, box=None):
+        if box is None and self.has_stats:
+            return self.stats_count(zooms)
+        condition, args = box_condition(box, 'x', 'y')
         R = 0
         for zoom in zooms:
-            self.execute('SELECT COUNT(*) FROM tiles WHERE z = ?', 17 - zoom)
+            self.execute('SELECT COUNT(*) FROM tiles WHERE z = ?' + condition, 17 - zoom, *args)
             r = self.cursor.fetchall()
             R += r[0][0]
         return R
 
-    def list_tiles(self, zooms):
+    def list_tiles(self, zooms, box=None):
+        condition, args = box_condition(box, 'x', 'y')
         R = []
         for zoom in zooms:
-            self.execute('SELECT x,y,z FROM tiles WHERE z = ?', 17 - zoom)
+            self.execute('SELECT x,y,z FROM tiles WHERE z = ?' + condition, 17 - zoom, *args)
             rows = self.cursor.fetchall()
             R.extend([(x, y, zoom) for (x, y, z) in rows])
         return R
 
-class FolderDatabase(TileDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        TileDatabase.__init__(self, db_name, tile_format, url_template)
+    def iter_tiles(self, zooms, box=None):
+        condition, args = box_condition(box, 'x', 'y')
+        for zoom in zooms:
+            for x, y in self.iter_pages('SELECT rowid,x,y FROM tiles WHERE z = ?' + condition, 17 - zoom, *args):
+                yield x, y, zoom
 
-    def filename(self, x, y, zoom):
-        return os.path.join(self.fullname,
-                            str(zoom), str(x), str(y) + '.' + self.tile_ext())
+def tms_row(y, zoom):
+    # y from the north, rows from the south, works both ways
+    return 2 ** zoom - 1 - y
 
-    def exists(self, x, y, zoom):
-        filename = self.filename(x, y, zoom)
-        if os.path.exists(filename):
-            return True, int(math.trunc(os.path.getmtime(filename)))
+def tms_box(box, zoom):
+    if box is None:
+        return None
+    else:
+        xmin, ymin, xmax, ymax = box
+        return xmin, tms_row(ymax, zoom), xmax, tms_row(ymin, zoom)
+
+class MbtilesDatabase(SqliteDatabase):
+    """
+    MBTiles database. Rows are numbered from the south (TMS scheme) and tile
+    dates are not stored. Bounds and zoom range of metadata are extended with
+    the tiles inserted and written at commit. Files where tiles is a view,
+    as written by mbutil or TileMill storing images once in a map and an
+    images table, are read only.
+    """
+    STATS_COLUMNS = dict(zoom='{row}zoom_level', x='{row}tile_column',
+                         y='((1 << {row}zoom_level) - 1 - {row}tile_row)', date='NULL',
+                         size='length(CAST({row}tile_data AS blob))')
+
+    def __init__(self, db_name, tile_format, url_template, pragmas=None):
+        SqliteDatabase.__init__(self, db_name, tile_format, url_template, pragmas)
+        tiles_type = self.table_type('tiles')
+        new = tiles_type is None
+        self.readonly = tiles_type == 'view'
+        if not self.readonly:
+            self.execute('CREATE TABLE IF NOT EXISTS metadata (name text, value text)')
+            self.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+            self.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+
+        if self.has_table('metadata'):
+            self.execute('SELECT name, value FROM metadata')
+            self.metadata = dict((decode_text(name), decode_text(value)) for name, value in self.cursor.fetchall())
         else:
-            return False, None
+            self.metadata = dict()
+        if 'name' not in self.metadata:
+            self.metadata['name'] = os.path.splitext(os.path.basename(db_name))[0]
+            self.metadata['type'] = 'baselayer'
+            self.metadata['version'] = '1.0'
+            self.metadata['description'] = 'Created by %s' % APPNAME
+            self.metadata_changed = True
+        else:
+            self.metadata_changed = False
+        if tile_format:
+            if self.metadata.get('format') != self.tile_ext():
+                self.metadata['format'] = self.tile_ext()
+                self.metadata_changed = True
+
+        # extent of tiles as (lon_min, lat_min, lon_max, lat_max) and zoom range
+        if 'bounds' in self.metadata:
+            self.bounds = [float(v) for v in self.metadata['bounds'].split(',')]
+        else:
+            self.bounds = None
+        if 'minzoom' in self.metadata:
+            self.zooms = [int(self.metadata['minzoom']), int(self.metadata['maxzoom'])]
+        else:
+            self.zooms = None
+        self.commit()
+        self.init_stats(new)
+
+    def exists(self, x, y, zoom):
+        presence = self.prefetched(x, y, zoom)
+        if presence is not None:
+            return presence.exists(x, y)
+        self.execute('SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                     zoom, x, tms_row(y, zoom))
+        return self.cursor.fetchone() is not None, None
+
+    def tile_dates(self, zoom, box=None):
+        condition, args = box_condition(tms_box(box, zoom), 'tile_column', 'tile_row')
+        self.execute('SELECT tile_column,tile_row FROM tiles WHERE zoom_level = ?' + condition, zoom, *args)
+        return [(x, tms_row(row, zoom), None) for x, row in self.cursor.fetchall()]
 
     def retrieve(self, x, y, zoom):
-        filename = self.filename(x, y, zoom)
-        if os.path.exists(filename):
-            try:
-                img = Image.open(filename)
-                return True, int(math.trunc(os.path.getmtime(filename))), img
-            except:
-                return None, None, None
-        else:
+        exists, date, tile_buffer = self.retrieve_buffer(x, y, zoom)
+        if not exists:
             return False, None, None
+        else:
+            return True, None, create_image_from_blob(tile_buffer)
 
     def retrieve_buffer(self, x, y, zoom):
-        filename = self.filename(x, y, zoom)
-        if os.path.exists(filename):
-            try:
-                with open(filename, 'rb') as f:
-                    buffer = f.read()
-                return True, int(math.trunc(os.path.getmtime(filename))), buffer
-            except:
-                return None, None, None
-        else:
+        self.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                     zoom, x, tms_row(y, zoom))
+        row = self.cursor.fetchone()
+        if row is None:
             return False, None, None
-
-    def update(self, date, x, y, zoom, tile):
-        filename = self.filename(x, y, zoom)
-        path = os.path.dirname(filename)
-        try:
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-            with open(filename, 'wb') as f:
-                f.write(tile)
-
-            if date is not None:
-                try:
-                    os.utime(filename, (date, date))
-                except:
-                    # utime does not work under android, avoid the error message
-                    pass
-        except:
-            error('unable to save ' + filename)
-
-    def delete(self, x, y, zoom):
-        filename = self.filename(x, y, zoom)
-        if os.path.exists(filename):
-            try:
-                os.remove(filename)
-                return True
-            except WindowsError as e:
-                return False
         else:
-            return True
+            return True, None, row[0]
+
+    def check_writable(self):
+        if self.readonly:
+            error('tiles of %s are stored in a view, the database is read only' % self.fullname)
+
+    def update_many(self, rows):
+        self.check_writable()
+        self.cursor.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?)',
+                                [(zoom, x, tms_row(y, zoom), tile) for _, x, y, zoom, tile in rows])
+        for _, x, y, zoom, _ in rows:
+            self.presence_update(x, y, zoom, None)
+            self.extend_metadata(x, y, zoom)
+
+    def extend_metadata(self, x, y, zoom):
+        # bounds and zoom range are not reduced when deleting tiles
+        lat_max, lon_min = tile2deg(x, y, zoom)
+        lat_min, lon_max = tile2deg(x + 1, y + 1, zoom)
+        if self.bounds is None:
+            self.bounds = [lon_min, lat_min, lon_max, lat_max]
+            self.zooms = [zoom, zoom]
+            self.metadata_changed = True
+        elif (lon_min < self.bounds[0] or lat_min < self.bounds[1] or
+              lon_max > self.bounds[2] or lat_max > self.bounds[3] or
+              not self.zooms[0] <= zoom <= self.zooms[1]):
+            self.bounds = [min(self.bounds[0], lon_min), min(self.bounds[1], lat_min),
+                           max(self.bounds[2], lon_max), max(self.bounds[3], lat_max)]
+            self.zooms = [min(self.zooms[0], zoom), max(self.zooms[1], zoom)]
+            self.metadata_changed = True
 
-    def regexp_filename(self):
-        re_path = r'[^\d](\d+)[^\d](\d+)[^\d]'
-        re_name = r'(\d+)\.%s$' % self.tile_ext()
-        return re_path + re_name
+    def delete(self, x, y, zoom):
+        self.check_writable()
+        self.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                     zoom, x, tms_row(y, zoom))
+        self.presence_delete(x, y, zoom)
+        return True
 
-    def list_tiles(self, zooms):
-        regexp = re.compile(self.regexp_filename())
-        R = []
+    def count_tiles(self, zooms, box=None):
+        if box is None and self.has_stats:
+            return self.stats_count(zooms)
+        R = 0
         for zoom in zooms:
-            path = os.path.join(self.fullname, str(zoom))
-            for root, dirs, files in os.walk(path):
-                if files:
-                    for filename in files:
-                        fullname = os.path.join(root, filename)
-                        m = regexp.search(fullname)
-                        if m:
-                            zoom, x, y = m.group(1,2,3)
-                            zoom, x, y = int(zoom), int(x), int(y)
-                            R.append((x, y, zoom))
+            condition, args = box_condition(tms_box(box, zoom), 'tile_column', 'tile_row')
+            self.execute('SELECT COUNT(*) FROM tiles WHERE zoom_level = ?' + condition, zoom, *args)
+            R += self.cursor.fetchone()[0]
         return R
 
-    def count_tiles(self, zooms):
-        regexp = re.compile(self.regexp_filename())
-        R = 0
+    def list_tiles(self, zooms, box=None):
+        R = []
         for zoom in zooms:
-            path = os.path.join(self.fullname, str(zoom))
-            for root, dirs, files in os.walk(path):
-                if files:
-                    for file in files:
-                        fullname = os.path.join(root, file)
-                        m = regexp.search(fullname)
-                        if m:
-                            R += 1
+            condition, args = box_condition(tms_box(box, zoom), 'tile_column', 'tile_row')
+            self.execute('SELECT tile_column,tile_row FROM tiles WHERE zoom_level = ?' + condition, zoom, *args)
+            R.extend([(x, tms_row(row, zoom), zoom) for x, row in self.cursor.fetchall()])
         return R
 
-    def pack(self):
-        for _ in (1, 2):
-            for root, dirs, files in os.walk(self.fullname):
-                if not dirs and not files:
-                    os.rmdir(root)
-
-class MaverickDatabase(FolderDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        FolderDatabase.__init__(self, db_name, tile_format, url_template)
+    def iter_tiles(self, zooms, box=None):
+        if self.readonly:
+            # views have no rowid to page on, rows are read with their own
+            # cursor as the database is not updated
+            for zoom in zooms:
+                condition, args = box_condition(tms_box(box, zoom), 'tile_column', 'tile_row')
+                cursor = self.conn.cursor()
+                cursor.execute('SELECT tile_column,tile_row FROM tiles WHERE zoom_level = ?' + condition,
+                               (zoom,) + args)
+                for x, row in cursor:
+                    yield x, tms_row(row, zoom), zoom
+        else:
+            for zoom in zooms:
+                condition, args = box_condition(tms_box(box, zoom), 'tile_column', 'tile_row')
+                for x, row in self.iter_pages('SELECT rowid,tile_column,tile_row FROM tiles WHERE zoom_level = ?' + condition,
+                                              zoom, *args):
+                    yield x, tms_row(row, zoom), zoom
 
-    def filename(self, x, y, zoom):
-        return FolderDatabase.filename(self, x, y, zoom) + '.tile'
+    def rebuild_stats(self):
+        self.check_writable()
+        SqliteDatabase.rebuild_stats(self)
 
-    def regexp_filename(self):
-        re_path = r'[^\d](\d+)[^\d](\d+)[^\d]'
-        re_name = r'(\d+)\.%s\.tile$' % self.tile_ext()
-        return re_path + re_name
+    def commit(self):
+        if self.metadata_changed and not self.readonly:
+            if self.bounds is not None:
+                self.metadata['bounds'] = ','.join('%.6f' % v for v in self.bounds)
+                self.metadata['minzoom'] = str(self.zooms[0])
+                self.metadata['maxzoom'] = str(self.zooms[1])
+            self.execute('DELETE FROM metadata')
+            self.cursor.executemany('INSERT INTO metadata VALUES (?,?)', sorted(self.metadata.items()))
+            self.metadata_changed = False
+        SqliteDatabase.commit(self)
+
+# listing of folder databases, following the zoom/x/y layout. Coordinates are
+# parsed from directory and file names and file types are given by scandir
+# without reading file attributes when available.
+
+def scan_dirs(path, first=None, last=None):
+    # generate (n, path) for directories of path named by an integer n,
+    # between first and last if given
+    if scandir is not None:
+        entries = ((entry.name, entry.path, entry.is_dir) for entry in scandir(path))
+    else:
+        entries = ((name, os.path.join(path, name), None) for name in os.listdir(path))
+    for name, dirpath, is_dir in entries:
+        if not name.isdigit():
+            continue
+        n = int(name)
+        if first is not None and not first <= n <= last:
+            continue
+        if is_dir() if is_dir is not None else os.path.isdir(dirpath):
+            yield n, dirpath
+
+def scan_files(path, suffix, first=None, last=None):
+    # list (n, path) for files of path named by an integer n followed by
+    # suffix, between first and last if given
+    files = []
+    if scandir is not None:
+        entries = ((entry.name, entry) for entry in scandir(path))
+    else:
+        entries = ((name, None) for name in os.listdir(path))
+    for name, entry in entries:
+        if not name.endswith(suffix):
+            continue
+        number = name[:-len(suffix)]
+        if not number.isdigit():
+            continue
+        n = int(number)
+        if first is not None and not first <= n <= last:
+            continue
+        files.append((n, os.path.join(path, name) if entry is None else entry.path))
+    return files
+
+def scan_tile_files(path, suffix, box=None, threads=1):
+    # generate (x, y, filename) for tiles of zoom level directory, x
+    # directories and y files outside box are not considered. x directories
+    # are scanned in parallel with several threads.
+    if not os.path.isdir(path):
+        return
+    xmin, ymin, xmax, ymax = (None,) * 4 if box is None else box
+    if threads <= 1:
+        for x, xpath in scan_dirs(path, xmin, xmax):
+            for y, filename in scan_files(xpath, suffix, ymin, ymax):
+                yield x, y, filename
+        return
 
-# persistence of database properties
+    jobs = queue.Queue()
+    for job in scan_dirs(path, xmin, xmax):
+        jobs.put(job)
+    # lists of tiles of x directories, None when a thread ends
+    results = queue.Queue(maxsize=4 * threads)
+    stop = threading.Event()
 
-class DatabaseProperties:
-    def __init__(self, db_name):
-        norm_name = os.path.normpath(db_name)
-        self.db_name = os.path.split(norm_name)[-1]
-        self.filename = norm_name + '.properties'
-        self.dirname = os.path.dirname(self.filename)
-        self.section = 'tile_database_properties'
-        self.warning = '; This file has been created by %s.\n' % APPNAME
-        self.parser = configparser.ConfigParser(allow_no_value=True)
-        self.parser.add_section(self.section)
+    def worker():
+        try:
+            while not stop.is_set():
+                try:
+                    x, xpath = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                results.put([(x, y, filename) for y, filename in scan_files(xpath, suffix, ymin, ymax)])
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(None)
 
-    def get(self):
-        if not os.path.isfile(self.filename):
-            return None, None, None
-        else:
-            self.parser.read(self.filename)
-            return (self.parser.get(self.section, 'db_format'),
-                    self.parser.get(self.section, 'tile_format'),
-                    self.parser.get(self.section, 'url_template'))
+    for _ in range(threads):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
 
-    def set(self, db_format, tile_format, url_template):
-        self.parser.set(self.section, 'db_name', self.db_name)
-        self.parser.set(self.section, 'db_format', db_format)
+    running = threads
+    try:
+        while running > 0:
+            result = results.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                for tile in result:
+                    yield tile
+    finally:
+        # on early exit, threads end after their current directory
+        stop.set()
+        while running > 0:
+            if results.get() is None:
+                running -= 1
+
+def dir_mtime(path):
+    # modification time of directory, None if removed
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class FolderManifest:
+    """
+    Index of the tiles of a folder database in a sqlite file beside the
+    folder, giving presence, date and size of tiles without reading the
+    folder. Modification times of directories are recorded to rescan only
+    the directories changed by other applications.
+    """
+    TABLES = (
+        'CREATE TABLE IF NOT EXISTS tiles (zoom integer, x integer, y integer, date integer, size integer, '
+        'PRIMARY KEY (zoom, x, y)) WITHOUT ROWID',
+        # x is -1 for zoom level directories
+        'CREATE TABLE IF NOT EXISTS dirs (zoom integer, x integer, mtime real, '
+        'PRIMARY KEY (zoom, x)) WITHOUT ROWID')
+
+    def __init__(self, filename):
+        self.connections = SqliteConnectionPool(filename, dict())
+        for request in self.TABLES:
+            self.execute(request)
+        self.commit()
+
+    def execute(self, request, *args):
+        cursor = self.connections.connection()[1]
+        cursor.execute(request, args)
+        return cursor
+
+    def tile(self, zoom, x, y):
+        # return (date, size) of tile, None if missing
+        return self.execute('SELECT date, size FROM tiles WHERE zoom = ? AND x = ? AND y = ?',
+                            zoom, x, y).fetchone()
+
+    def tile_dates(self, zoom, box=None):
+        condition, args = box_condition(box, 'x', 'y')
+        return self.execute('SELECT x, y, date FROM tiles WHERE zoom = ?' + condition, zoom, *args).fetchall()
+
+    def count(self, zoom, box=None):
+        condition, args = box_condition(box, 'x', 'y')
+        return self.execute('SELECT COUNT(*) FROM tiles WHERE zoom = ?' + condition, zoom, *args).fetchone()[0]
+
+    def iter_tiles(self, zoom, box=None):
+        # pages follow the primary key, without keeping a statement open
+        condition, args = box_condition(box, 'x', 'y')
+        x, y = -1, -1
+        while True:
+            rows = self.execute('SELECT x, y FROM tiles WHERE zoom = ? AND (x > ? OR x = ? AND y > ?)' + condition +
+                                ' ORDER BY x, y LIMIT ?', zoom, x, x, y, *(args + (ITER_PAGE_SIZE,))).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            x, y = rows[-1]
+
+    def column(self, zoom, x):
+        # return a dictionary of sizes of tiles of column indexed by y
+        return dict(self.execute('SELECT y, size FROM tiles WHERE zoom = ? AND x = ?', zoom, x).fetchall())
+
+    def update(self, zoom, x, y, date, size):
+        self.execute('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?)', zoom, x, y, date, size)
+
+    def touch(self, zoom, x, y, date):
+        self.execute('UPDATE tiles SET date = ? WHERE zoom = ? AND x = ? AND y = ?', date, zoom, x, y)
+
+    def delete(self, zoom, x, y):
+        self.execute('DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?', zoom, x, y)
+
+    def dir_mtimes(self):
+        # return a dictionary of modification times indexed by (zoom, x)
+        return dict(((zoom, x), mtime) for zoom, x, mtime in self.execute('SELECT zoom, x, mtime FROM dirs').fetchall())
+
+    def set_dir(self, zoom, x, mtime):
+        if mtime is None:
+            self.execute('DELETE FROM dirs WHERE zoom = ? AND x = ?', zoom, x)
+        else:
+            self.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)', zoom, x, mtime)
+
+    def commit(self):
+        self.connections.connection()[0].commit()
+
+    def close(self):
+        self.connections.close()
+
+class FolderDatabase(TileDatabase):
+    """
+    Tiles stored as files in zoom and x directories. Statistics are kept in a
+    json file beside the folder, maintained for new databases or after
+    rebuilding them. The file is marked dirty while changes are not saved,
+    statistics of an interrupted session are then ignored. Presence, dates
+    and sizes of tiles are given by a manifest, maintained in the same
+    conditions when sqlite is available, and refreshed when opening the
+    database with the directories changed since the last session.
+    """
+    def __init__(self, db_name, tile_format, url_template, scan_threads=1):
+        TileDatabase.__init__(self, db_name, tile_format, url_template)
+        # threads listing x directories
+        self.scan_threads = scan_threads
+        self.stats_filename = os.path.normpath(db_name) + '.stats'
+        self.stats = self.load_stats()
+        self.has_stats = self.stats is not None
+        self.stats_changed = False
+
+        # manifest of a new database is created with the first tiles
+        self.manifest_filename = os.path.normpath(db_name) + '.manifest'
+        self.manifest = None
+        self.manifest_pending = sqlite3_available and not os.path.exists(self.fullname)
+        # (zoom, x) of directories changed by this session
+        self.changed_dirs = set()
+        if sqlite3_available and not self.manifest_pending and os.path.isfile(self.manifest_filename):
+            self.manifest = FolderManifest(self.manifest_filename)
+            self.refresh_manifest()
+
+    def create_manifest(self):
+        if os.path.isfile(self.manifest_filename):
+            os.remove(self.manifest_filename)
+        self.manifest = FolderManifest(self.manifest_filename)
+        self.manifest_pending = False
+
+    def refresh_manifest(self):
+        # apply the changes made by other applications, zoom directories are
+        # listed again if changed, and columns rescanned if changed
+        known = self.manifest.dir_mtimes()
+        zooms = dict(scan_dirs(self.fullname)) if os.path.isdir(self.fullname) else dict()
+        for zoom in set(z for z, x in known if z not in zooms):
+            for x in [x for z, x in known if z == zoom and x >= 0]:
+                self.refresh_column(zoom, x, None, None)
+            self.manifest.set_dir(zoom, -1, None)
+
+        for zoom, zpath in zooms.items():
+            mtime = dir_mtime(zpath)
+            if known.get((zoom, -1)) == mtime:
+                columns = dict((x, os.path.join(zpath, str(x))) for z, x in known if z == zoom and x >= 0)
+            else:
+                columns = dict(scan_dirs(zpath))
+                for x in [x for z, x in known if z == zoom and x >= 0 and x not in columns]:
+                    self.refresh_column(zoom, x, None, None)
+                self.manifest.set_dir(zoom, -1, mtime)
+            for x, xpath in columns.items():
+                mtime = dir_mtime(xpath)
+                if mtime is None or known.get((zoom, x)) != mtime:
+                    self.refresh_column(zoom, x, xpath, mtime)
+        self.commit()
+
+    def refresh_column(self, zoom, x, xpath, mtime):
+        # rescan column directory, None if removed. Files replaced without
+        # changing the directory are not seen.
+        stored = self.manifest.column(zoom, x)
+        current = dict(scan_files(xpath, self.tile_suffix())) if mtime is not None else dict()
+        for y in set(stored) - set(current):
+            self.manifest.delete(zoom, x, y)
+            if self.has_stats:
+                self.stats_removing(zoom, stored[y])
+        for y in set(current) - set(stored):
+            stat = os.stat(current[y])
+            date = int(math.trunc(stat.st_mtime))
+            self.manifest.update(zoom, x, y, date, stat.st_size)
+            if self.has_stats:
+                self.stats_changing()
+                stats_add(self.stats, zoom, x, y, date, stat.st_size)
+        self.manifest.set_dir(zoom, x, mtime)
+
+    def load_stats(self):
+        if not os.path.exists(self.fullname):
+            return dict()
+        elif os.path.isfile(self.stats_filename):
+            try:
+                with open(self.stats_filename) as f:
+                    content = json.load(f)
+            except ValueError:
+                return None
+            if content['dirty']:
+                return None
+            return dict((int(zoom), s) for zoom, s in content['zooms'].items())
+        else:
+            return None
+
+    def save_stats(self, dirty):
+        with open(self.stats_filename, 'w') as f:
+            json.dump({'dirty': dirty, 'zooms': self.stats}, f)
+
+    def stats_changing(self):
+        if not self.stats_changed:
+            self.save_stats(dirty=True)
+            self.stats_changed = True
+
+    def stats_removing(self, zoom, size):
+        # tiles added by other applications without manifest are missing from
+        # statistics, which are then left dirty on disk until rebuilt
+        self.stats_changing()
+        if not stats_remove(self.stats, zoom, size):
+            self.stats = None
+            self.has_stats = False
+            self.stats_changed = False
+
+    def zoom_stats(self):
+        if not self.has_stats:
+            return None
+        return dict((zoom, tuple(s)) for zoom, s in self.stats.items())
+
+    def rebuild_stats(self):
+        # statistics and manifest are rebuilt together, the refresh of an
+        # empty manifest scans the whole folder
+        self.stats = dict()
+        self.has_stats = True
+        if sqlite3_available:
+            if self.manifest is not None:
+                self.manifest.close()
+            self.create_manifest()
+            self.refresh_manifest()
+        elif os.path.isdir(self.fullname):
+            for zoom, _ in scan_dirs(self.fullname):
+                for x, y, filename in self.tile_files(zoom):
+                    stat = os.stat(filename)
+                    stats_add(self.stats, zoom, x, y, int(math.trunc(stat.st_mtime)), stat.st_size)
+        self.save_stats(dirty=False)
+        self.stats_changed = False
+
+    def filename(self, x, y, zoom):
+        return os.path.join(self.fullname,
+                            str(zoom), str(x), str(y) + '.' + self.tile_ext())
+
+    def tile_suffix(self):
+        return '.' + self.tile_ext()
+
+    def exists(self, x, y, zoom):
+        presence = self.prefetched(x, y, zoom)
+        if presence is not None:
+            return presence.exists(x, y)
+        if self.manifest is not None:
+            row = self.manifest.tile(zoom, x, y)
+            return (False, None) if row is None else (True, row[0])
+        try:
+            return True, int(math.trunc(os.stat(self.filename(x, y, zoom)).st_mtime))
+        except OSError:
+            return False, None
+
+    def stored_size(self, filename, x, y, zoom):
+        # size of stored tile from manifest or file, None if missing. Without
+        # manifest, statistics cost a stat for each tile written or deleted.
+        if self.manifest is not None:
+            row = self.manifest.tile(zoom, x, y)
+            return None if row is None else row[1]
+        try:
+            return os.stat(filename).st_size
+        except OSError:
+            return None
+
+    def tile_files(self, zoom, box=None):
+        # generate (x, y, filename) for tiles of zoom level, x directories and
+        # y files outside box are not considered
+        suffix = self.tile_suffix()
+        path = os.path.join(self.fullname, str(zoom))
+        return scan_tile_files(path, suffix, box, self.scan_threads)
+
+    def tile_dates(self, zoom, box=None):
+        if self.manifest is not None:
+            return self.manifest.tile_dates(zoom, box)
+        return [(x, y, int(math.trunc(os.path.getmtime(filename))))
+                for x, y, filename in self.tile_files(zoom, box)]
+
+    def retrieve(self, x, y, zoom):
+        exists, date, tile_buffer = self.retrieve_buffer(x, y, zoom)
+        if not exists:
+            return exists, None, None
+        try:
+            return True, date, create_image_from_blob(tile_buffer)
+        except:
+            return None, None, None
+
+    def retrieve_buffer(self, x, y, zoom):
+        # date is given by the open file, missing tiles by the failed open
+        try:
+            f = open(self.filename(x, y, zoom), 'rb')
+        except (IOError, OSError) as e:
+            return (False if e.errno == errno.ENOENT else None), None, None
+        try:
+            with f:
+                date = int(math.trunc(os.fstat(f.fileno()).st_mtime))
+                return True, date, f.read()
+        except:
+            return None, None, None
+
+    def update(self, date, x, y, zoom, tile):
+        filename = self.filename(x, y, zoom)
+        path = os.path.dirname(filename)
+        if self.manifest_pending:
+            self.create_manifest()
+        if self.has_stats:
+            self.stats_changing()
+            size = self.stored_size(filename, x, y, zoom)
+            if size is not None:
+                self.stats_removing(zoom, size)
+        try:
+            # directories are created when missing for the first tile of
+            # a column, without testing them for each tile
+            try:
+                f = open(filename, 'wb')
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                os.makedirs(path)
+                f = open(filename, 'wb')
+            with f:
+                f.write(tile)
+
+            if date is not None:
+                try:
+                    os.utime(filename, (date, date))
+                except:
+                    # utime does not work under android, avoid the error message
+                    pass
+        except:
+            error('unable to save ' + filename)
+        if date is None:
+            date = int(math.trunc(time()))
+        if self.has_stats:
+            stats_add(self.stats, zoom, x, y, date, len(tile))
+        if self.manifest is not None:
+            self.manifest.update(zoom, x, y, date, len(tile))
+            self.changed_dirs.add((zoom, x))
+        self.presence_update(x, y, zoom, date)
+
+    def touch(self, date, x, y, zoom):
+        try:
+            os.utime(self.filename(x, y, zoom), (date, date))
+        except:
+            # utime does not work under android
+            pass
+        if self.has_stats:
+            self.stats_changing()
+            stats_touch(self.stats, zoom, date)
+        if self.manifest is not None:
+            self.manifest.touch(zoom, x, y, date)
+        self.presence_update(x, y, zoom, date)
+
+    def delete(self, x, y, zoom):
+        filename = self.filename(x, y, zoom)
+        size = self.stored_size(filename, x, y, zoom) if self.has_stats else None
+        try:
+            os.remove(filename)
+        except OSError as e:
+            # a missing tile is not a failure
+            return e.errno == errno.ENOENT
+        if size is not None:
+            self.stats_removing(zoom, size)
+        if self.manifest is not None:
+            self.manifest.delete(zoom, x, y)
+            self.changed_dirs.add((zoom, x))
+        self.presence_delete(x, y, zoom)
+        return True
+
+    def list_tiles(self, zooms, box=None):
+        return list(self.iter_tiles(zooms, box))
+
+    def iter_tiles(self, zooms, box=None):
+        for zoom in zooms:
+            if self.manifest is not None:
+                for x, y in self.manifest.iter_tiles(zoom, box):
+                    yield x, y, zoom
+            else:
+                for x, y, _ in self.tile_files(zoom, box):
+                    yield x, y, zoom
+
+    def count_tiles(self, zooms, box=None):
+        if box is None and self.has_stats:
+            return self.stats_count(zooms)
+        R = 0
+        for zoom in zooms:
+            if self.manifest is not None:
+                R += self.manifest.count(zoom, box)
+            else:
+                R += sum(1 for _ in self.tile_files(zoom, box))
+        return R
+
+    def commit(self):
+        if self.manifest is not None:
+            # directories changed by this session are not rescanned
+            for zoom, x in self.changed_dirs:
+                zpath = os.path.join(self.fullname, str(zoom))
+                self.manifest.set_dir(zoom, x, dir_mtime(os.path.join(zpath, str(x))))
+                self.manifest.set_dir(zoom, -1, dir_mtime(zpath))
+            self.changed_dirs = set()
+            self.manifest.commit()
+        if self.stats_changed:
+            self.save_stats(dirty=False)
+            self.stats_changed = False
+
+    def close(self):
+        # statistics and manifest follow the files already written
+        self.commit()
+        if self.manifest is not None:
+            self.manifest.close()
+
+    def pack(self):
+        for _ in (1, 2):
+            for root, dirs, files in os.walk(self.fullname):
+                if not dirs and not files:
+                    os.rmdir(root)
+
+class MaverickDatabase(FolderDatabase):
+    def __init__(self, db_name, tile_format, url_template, scan_threads=1):
+        FolderDatabase.__init__(self, db_name, tile_format, url_template, scan_threads)
+
+    def filename(self, x, y, zoom):
+        return FolderDatabase.filename(self, x, y, zoom) + '.tile'
+
+    def tile_suffix(self):
+        return FolderDatabase.tile_suffix(self) + '.tile'
+
+# bundle files, blocks of BUNDLE_SIZE x BUNDLE_SIZE tiles of a zoom level
+
+BUNDLE_SIZE = 128
+BUNDLE_MAGIC = b'KHB1'
+# index entry of a tile: offset in file (0 if missing), size and date
+BUNDLE_ENTRY = struct.Struct('<QII')
+BUNDLE_INDEX = struct.Struct('<' + 'QII' * BUNDLE_SIZE * BUNDLE_SIZE)
+BUNDLE_HEADER = len(BUNDLE_MAGIC) + BUNDLE_INDEX.size
+# maximum number of bundle files kept open
+BUNDLES_OPEN = 64
+# bundles with a larger part of their data replaced or deleted are compacted
+# when committing
+BUNDLE_GARBAGE = 0.5
+
+def replace_file(source, destination):
+    # atomic replacement, rename does not replace files under windows before
+    # python 3.3
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        if os.name == 'nt' and os.path.isfile(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+class Bundle:
+    """
+    Data file of a block of tiles. The file starts with a fixed size index
+    giving offset, size and date of each tile, followed by the images in the
+    order they are stored. Images are appended, the index entry is then
+    rewritten, replaced and deleted images stay in the file until compaction.
+    Reads are done through a memory map of the file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        if not os.path.isfile(filename):
+            with open(filename, 'wb') as f:
+                f.write(BUNDLE_MAGIC)
+                f.truncate(BUNDLE_HEADER)
+        # unbuffered, writes are seen by the map
+        self.file = open(filename, 'r+b', buffering=0)
+        self.map = None
+        self.remap()
+        if self.map[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            self.close()
+            error('%s is not a bundle file' % filename)
+
+    def remap(self):
+        # map the whole file, done again when reading past the end of the map
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def entry(self, index):
+        return BUNDLE_ENTRY.unpack_from(self.map, len(BUNDLE_MAGIC) + index * BUNDLE_ENTRY.size)
+
+    def entries(self):
+        # list (index, offset, size, date) of tiles stored
+        values = BUNDLE_INDEX.unpack_from(self.map, len(BUNDLE_MAGIC))
+        return [(index, values[3 * index], values[3 * index + 1], values[3 * index + 2])
+                for index in range(BUNDLE_SIZE * BUNDLE_SIZE) if values[3 * index]]
+
+    def read(self, offset, size):
+        if offset + size > len(self.map):
+            self.remap()
+        return self.map[offset:offset + size]
+
+    def set_entry(self, index, offset, size, date):
+        self.file.seek(len(BUNDLE_MAGIC) + index * BUNDLE_ENTRY.size)
+        self.file.write(BUNDLE_ENTRY.pack(offset, size, date))
+
+    def write(self, index, tile, date):
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        self.file.write(tile)
+        self.set_entry(index, offset, len(tile), date)
+
+    def garbage(self):
+        # part of image data no longer referenced by the index
+        data = self.size() - BUNDLE_HEADER
+        if data == 0:
+            return 0.0
+        return float(data - sum(entry[2] for entry in self.entries())) / data
+
+    def compact(self):
+        # write images referenced by the index in a new file replacing the
+        # bundle, the bundle is closed and removed if empty
+        entries = self.entries()
+        if entries:
+            index = bytearray(BUNDLE_HEADER)
+            index[:len(BUNDLE_MAGIC)] = BUNDLE_MAGIC
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'wb') as f:
+                f.write(index)
+                offset = BUNDLE_HEADER
+                for n, tile_offset, size, date in entries:
+                    f.write(self.read(tile_offset, size))
+                    BUNDLE_ENTRY.pack_into(index, len(BUNDLE_MAGIC) + n * BUNDLE_ENTRY.size, offset, size, date)
+                    offset += size
+                f.seek(0)
+                f.write(index)
+                # the new file is complete on disk before replacing the bundle
+                f.flush()
+                os.fsync(f.fileno())
+            self.close()
+            replace_file(tmpname, self.filename)
+        else:
+            self.close()
+            os.remove(self.filename)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class BundleDatabase(TileDatabase):
+    """
+    Tiles stored in bundle files, one for each block of BUNDLE_SIZE x
+    BUNDLE_SIZE tiles of a zoom level, named by the block coordinates in zoom
+    directories. Bundles with too much data replaced or deleted are compacted
+    when committing, and all bundles when packing.
+    """
+    def __init__(self, db_name, tile_format, url_template):
+        TileDatabase.__init__(self, db_name, tile_format, url_template)
+        # open bundles by (zoom, xblock, yblock), least recently used first
+        self.bundles = collections.OrderedDict()
+        # bundles with data replaced or deleted since last commit
+        self.changed = set()
+        # bundles and their maps are shared by threads of server
+        self.lock = threading.RLock()
+
+    def bundle_filename(self, zoom, xblock, yblock):
+        return os.path.join(self.fullname, str(zoom), '%d_%d.bundle' % (xblock, yblock))
+
+    def bundle(self, key, create=False):
+        # return open bundle (zoom, xblock, yblock), None if missing and not
+        # created
+        bundle = self.bundles.pop(key, None)
+        if bundle is None:
+            filename = self.bundle_filename(*key)
+            if not os.path.isfile(filename):
+                if not create:
+                    return None
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+            if len(self.bundles) >= BUNDLES_OPEN:
+                self.bundles.popitem(last=False)[1].close()
+            bundle = Bundle(filename)
+        self.bundles[key] = bundle
+        return bundle
+
+    def tile_bundle(self, x, y, zoom, create=False):
+        # return bundle of tile and index of tile in bundle
+        key = (zoom, x // BUNDLE_SIZE, y // BUNDLE_SIZE)
+        return key, self.bundle(key, create), (y % BUNDLE_SIZE) * BUNDLE_SIZE + x % BUNDLE_SIZE
+
+    def zoom_bundles(self, zoom, box=None):
+        # list (xblock, yblock) of bundle files of zoom level intersecting box
+        path = os.path.join(self.fullname, str(zoom))
+        if not os.path.isdir(path):
+            return []
+        blocks = []
+        for name in os.listdir(path):
+            match = re.match(r'(\d+)_(\d+)\.bundle$', name)
+            if match is None:
+                continue
+            xblock, yblock = int(match.group(1)), int(match.group(2))
+            if box is not None:
+                xmin, ymin, xmax, ymax = box
+                if not (xmin // BUNDLE_SIZE <= xblock <= xmax // BUNDLE_SIZE and
+                        ymin // BUNDLE_SIZE <= yblock <= ymax // BUNDLE_SIZE):
+                    continue
+            blocks.append((xblock, yblock))
+        return sorted(blocks)
+
+    def bundle_tiles(self, zoom, xblock, yblock, box=None):
+        # list (x, y, date) of tiles of bundle inside box
+        with self.lock:
+            bundle = self.bundle((zoom, xblock, yblock))
+            entries = bundle.entries() if bundle is not None else []
+        tiles = []
+        for index, _, _, date in entries:
+            x = xblock * BUNDLE_SIZE + index % BUNDLE_SIZE
+            y = yblock * BUNDLE_SIZE + index // BUNDLE_SIZE
+            if box is None or (box[0] <= x <= box[2] and box[1] <= y <= box[3]):
+                tiles.append((x, y, date))
+        return tiles
+
+    def exists(self, x, y, zoom):
+        presence = self.prefetched(x, y, zoom)
+        if presence is not None:
+            return presence.exists(x, y)
+        with self.lock:
+            _, bundle, index = self.tile_bundle(x, y, zoom)
+            if bundle is None:
+                return False, None
+            offset, _, date = bundle.entry(index)
+            return (True, date) if offset else (False, None)
+
+    def tile_dates(self, zoom, box=None):
+        return [tile for xblock, yblock in self.zoom_bundles(zoom, box)
+                for tile in self.bundle_tiles(zoom, xblock, yblock, box)]
+
+    def retrieve(self, x, y, zoom):
+        exists, date, tile_buffer = self.retrieve_buffer(x, y, zoom)
+        if not exists:
+            return exists, None, None
+        try:
+            return True, date, create_image_from_blob(tile_buffer)
+        except:
+            return None, None, None
+
+    def retrieve_buffer(self, x, y, zoom):
+        try:
+            with self.lock:
+                _, bundle, index = self.tile_bundle(x, y, zoom)
+                if bundle is None:
+                    return False, None, None
+                offset, size, date = bundle.entry(index)
+                if offset == 0:
+                    return False, None, None
+                return True, date, bundle.read(offset, size)
+        except CustomException:
+            raise
+        except:
+            return None, None, None
+
+    def update(self, date, x, y, zoom, tile):
+        if date is None:
+            date = int(math.trunc(time()))
+        with self.lock:
+            try:
+                key, bundle, index = self.tile_bundle(x, y, zoom, create=True)
+                if bundle.entry(index)[0]:
+                    self.changed.add(key)
+                bundle.write(index, tile, date)
+            except CustomException:
+                raise
+            except:
+                error('unable to save tile in ' + self.bundle_filename(zoom, x // BUNDLE_SIZE, y // BUNDLE_SIZE))
+        self.presence_update(x, y, zoom, date)
+
+    def touch(self, date, x, y, zoom):
+        with self.lock:
+            _, bundle, index = self.tile_bundle(x, y, zoom)
+            if bundle is not None:
+                offset, size, _ = bundle.entry(index)
+                if offset:
+                    bundle.set_entry(index, offset, size, date)
+        self.presence_update(x, y, zoom, date)
+
+    def delete(self, x, y, zoom):
+        with self.lock:
+            key, bundle, index = self.tile_bundle(x, y, zoom)
+            if bundle is not None and bundle.entry(index)[0]:
+                bundle.set_entry(index, 0, 0, 0)
+                self.changed.add(key)
+        self.presence_delete(x, y, zoom)
+        return True
+
+    def list_tiles(self, zooms, box=None):
+        return list(self.iter_tiles(zooms, box))
+
+    def iter_tiles(self, zooms, box=None):
+        for zoom in zooms:
+            for xblock, yblock in self.zoom_bundles(zoom, box):
+                for x, y, _ in self.bundle_tiles(zoom, xblock, yblock, box):
+                    yield x, y, zoom
+
+    def count_tiles(self, zooms, box=None):
+        return sum(len(self.bundle_tiles(zoom, xblock, yblock, box))
+                   for zoom in zooms for xblock, yblock in self.zoom_bundles(zoom, box))
+
+    def compact(self, keys, threshold):
+        # compact bundles with a part of garbage above threshold
+        with self.lock:
+            for key in sorted(keys):
+                bundle = self.bundle(key)
+                if bundle is not None and bundle.garbage() > threshold:
+                    del self.bundles[key]
+                    bundle.compact()
+
+    def commit(self):
+        # data is written when storing, commit compacts bundles when needed
+        self.compact(self.changed, BUNDLE_GARBAGE)
+        self.changed = set()
+
+    def reclaim(self, threshold, pages):
+        # bundles changed are compacted in one pass, pages are not used
+        self.compact(self.changed, threshold)
+        self.changed = set()
+
+    def pack(self):
+        keys = []
+        if os.path.isdir(self.fullname):
+            for zoom, _ in scan_dirs(self.fullname):
+                keys.extend((zoom, xblock, yblock) for xblock, yblock in self.zoom_bundles(zoom))
+        self.compact(keys, 0.0)
+        self.changed = set()
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            for bundle in self.bundles.values():
+                bundle.close()
+            self.bundles.clear()
+
+# persistence of database properties
+
+class DatabaseProperties:
+    def __init__(self, db_name):
+        norm_name = os.path.normpath(db_name)
+        self.db_name = os.path.split(norm_name)[-1]
+        self.filename = norm_name + '.properties'
+        self.dirname = os.path.dirname(self.filename)
+        self.section = 'tile_database_properties'
+        self.warning = '; This file has been created by %s.\n' % APPNAME
+        self.parser = configparser.ConfigParser(allow_no_value=True)
+        self.parser.add_section(self.section)
+
+    def get(self):
+        if not os.path.isfile(self.filename):
+            return None, None, None
+        else:
+            self.parser.read(self.filename)
+            return (self.parser.get(self.section, 'db_format'),
+                    self.parser.get(self.section, 'tile_format'),
+                    self.parser.get(self.section, 'url_template'))
+
+    def get_option(self, key):
+        # optional entry of the properties, after get(), None if absent
+        if self.parser.has_option(self.section, key):
+            return self.parser.get(self.section, key)
+        else:
+            return None
+
+    def get_section(self, section):
+        # return the entries of an optional section as a dictionary
+        if os.path.isfile(self.filename):
+            self.parser.read(self.filename)
+        if self.parser.has_section(section):
+            return dict(self.parser.items(section))
+        else:
+            return dict()
+
+    def set(self, db_format, tile_format, url_template, dedup=None):
+        # other sections of an existing file are kept
+        if os.path.isfile(self.filename):
+            self.parser.read(self.filename)
+        self.parser.set(self.section, 'db_name', self.db_name)
+        self.parser.set(self.section, 'db_format', db_format)
         self.parser.set(self.section, 'url_template', url_template)
         self.parser.set(self.section, 'tile_format', tile_format)
+        if dedup is not None:
+            self.parser.set(self.section, 'dedup', dedup)
         if self.dirname and not os.path.exists(self.dirname):
             os.makedirs(self.dirname)
         try:
@@ -1572,22 +3422,72 @@ class DatabaseProperties:
 
 # database factory
 
-def db_factory(db_name):
-    db_format, tile_format, url_template = DatabaseProperties(db_name).get()
+def db_factory(db_name, options=None):
+    properties = DatabaseProperties(db_name)
+    db_format, tile_format, url_template = properties.get()
 
     if db_format is None:
         error('tile database format is not declared. Use -describe to describe database.')
     elif db_format == 'KAHELO':
-        return KaheloDatabase(db_name, tile_format, url_template)
+        version = kahelo_version(db_name)
+        if version == KaheloDatabase.VERSION:
+            return KaheloDatabase(db_name, tile_format, url_template,
+                                  sqlite_pragmas(options, properties))
+        elif version == Kahelo2Database.VERSION:
+            return Kahelo2Database(db_name, tile_format, url_template,
+                                   sqlite_pragmas(options, properties),
+                                   properties.get_option('dedup') == 'on')
+        else:
+            error('unknown version %d of kahelo database format' % version)
     elif db_format == 'RMAPS':
-        return RmapsDatabase(db_name, tile_format, url_template)
+        return RmapsDatabase(db_name, tile_format, url_template,
+                             sqlite_pragmas(options, properties))
+    elif db_format == 'MBTILES':
+        return MbtilesDatabase(db_name, tile_format, url_template,
+                               sqlite_pragmas(options, properties))
     elif db_format == 'FOLDER':
-        return FolderDatabase(db_name, tile_format, url_template)
+        return FolderDatabase(db_name, tile_format, url_template, scan_threads(options))
     elif db_format == 'MAVERICK':
-        return MaverickDatabase(db_name, tile_format, url_template)
+        return MaverickDatabase(db_name, tile_format, url_template, scan_threads(options))
+    elif db_format == 'BUNDLE':
+        return BundleDatabase(db_name, tile_format, url_template)
     else:
         error('unknown tile database format')
 
+def scan_threads(options):
+    return 1 if options is None else options.database.scan_threads
+
+def prefetch_tileset(db, tiles):
+    # replace one request per tile by one request per zoom level
+    for zoom, box in tiles.boxes.items():
+        db.prefetch(zoom, box)
+
+class TileWriter:
+    """
+    Buffer of tiles to store in database, written with one request for all
+    buffered tiles when the buffer is full and before each commit. Existence
+    of buffered tiles is answered by the prefetched presence information.
+    """
+    def __init__(self, db, size):
+        self.db = db
+        self.size = size
+        self.rows = []
+
+    def update(self, date, x, y, zoom, tile):
+        self.rows.append((date, x, y, zoom, tile))
+        self.db.presence_update(x, y, zoom, date)
+        if len(self.rows) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.db.update_many(self.rows)
+            self.rows = []
+
+    def commit(self):
+        self.flush()
+        self.db.commit()
+
 # -- Traces ------------------------------------------------------------------
 
 class TileCounters:
@@ -1600,6 +3500,7 @@ class TileCounters:
         self.deleted = 0
         self.missing = 0
         self.failure = 0
+        self.revalidated = 0
 
 def tile_trace(options, x, y, zoom, index, size, msg):
     if options.verbose:
@@ -1628,9 +3529,116 @@ def display_report(options, *entries):
             v = value
         print('%-16s %12s' % (caption, v))
 
+    if options.timer.enabled:
+        options.timer.report()
+        if options.timings:
+            options.timer.save(options.timings, options, entries)
+
+class PhaseTimer:
+    """
+    Time spent in each phase of a command (tile set generation, database
+    access, download, image conversion), enabled with -timings. Durations are
+    recorded by the download threads as well.
+    """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.durations = dict()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        # to be used with the with statement
+        if self.enabled:
+            return TimedPhase(self, name)
+        else:
+            return NULL_PHASE
+
+    def record(self, name, duration):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = array.array('d')
+                self.phases.append(name)
+            self.durations[name].append(duration)
+
+    def figures(self):
+        # list of (phase, calls, total, percentiles) in order of first use
+        figures = []
+        for name in self.phases:
+            durations = sorted(self.durations[name])
+            percentiles = [percentile(durations, p) for p in self.PERCENTILES]
+            figures.append((name, len(durations), sum(durations), percentiles))
+        return figures
+
+    def report(self):
+        print('-' * 29)
+        print('%-10s %9s %9s %9s %9s %9s' % ('Phase', 'Calls', 'Total s',
+              'p50 ms', 'p95 ms', 'p99 ms'))
+        for name, calls, total, percentiles in self.figures():
+            print('%-10s %9s %9.3f %9.3f %9.3f %9.3f' %
+                  ((name, decsep(calls), total) + tuple(1000 * p for p in percentiles)))
+
+    def save(self, filename, options, entries):
+        phases = dict()
+        for name, calls, total, percentiles in self.figures():
+            phases[name] = dict(calls=calls, total=total)
+            for p, value in zip(self.PERCENTILES, percentiles):
+                phases[name]['p%d' % p] = value
+
+        command = [name for name in ('insert', 'import', 'export', 'delete',
+                                     'count', 'view', 'stat')
+                   if getattr(options, 'db_' + name, None)]
+        timings = dict(version=VERSION,
+                       command=command[0] if command else None,
+                       db_name=options.db_name,
+                       elapsed=time() - options.start_time,
+                       report=dict(entries),
+                       phases=phases)
+        with open(filename, 'w') as f:
+            json.dump(timings, f, indent=4, sort_keys=True)
+
+class TimedPhase:
+    # helper class, context manager timing a phase
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.name, timeit.default_timer() - self.start)
+        return False
+
+class NullPhase:
+    # helper class, context manager used when timings are disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_PHASE = NullPhase()
+
+def percentile(values, p):
+    # nearest rank percentile of sorted values
+    if not values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
 def decsep(n):
     return '{:,}'.format(n)
 
+def decode_text(value):
+    # text values are returned as bytes by sqlite databases under python 3
+    if isinstance(value, bytes) and sys.version_info >= (3,):
+        return value.decode('latin-1')
+    else:
+        return value
+
 # -- Insertion strategies ----------------------------------------------------
 #
 # used by -insert and -import/-export
@@ -1706,7 +3714,9 @@ def do_helphtml():
 
 def do_describe(db_name, options):
 
-    db_format, tile_format, url_template = DatabaseProperties(db_name).get()
+    properties = DatabaseProperties(db_name)
+    db_format, tile_format, url_template = properties.get()
+    dedup = properties.get_option('dedup')
 
     if options.db_format is not None:
         db_format = options.db_format
@@ -1714,13 +3724,37 @@ def do_describe(db_name, options):
         tile_format = options.tile_format
     if options.url_template is not None:
         url_template = options.url_template
+    if options.dedup is not None:
+        dedup = options.dedup
+    if dedup == 'on' and db_format != 'KAHELO':
+        error('deduplication is available only for kahelo databases')
 
-    DatabaseProperties(db_name).set(db_format, tile_format, url_template)
+    DatabaseProperties(db_name).set(db_format, tile_format, url_template, dedup)
 
     print('db_name     ', db_name)
     print('db_format   ', db_format)
     print('tile_format ', tile_format)
     print('url_template', url_template)
+    if dedup is not None:
+        print('dedup       ', dedup)
+
+    # statistics of the tiles stored, if maintained, when the format is kept
+    if options.db_format is None and db_format and os.path.exists(db_name):
+        db = db_factory(db_name, options)
+        stats = db.zoom_stats()
+        db.close()
+        if stats is not None:
+            print('tiles       ', decsep(sum(s[0] for s in stats.values())))
+            print('bytes       ', decsep(sum(s[1] for s in stats.values())))
+
+    # images already stored are shared when enabling dedup
+    if options.dedup == 'on' and os.path.isfile(db_name):
+        db = db_factory(db_name, options)
+        if isinstance(db, Kahelo2Database):
+            print('deduplicated', db.deduplicate())
+        else:
+            print('deduplication requires latest kahelo format, use -migrate')
+        db.close()
 
 # -count : number of tiles for source and zoom -------------------------------
 
@@ -1733,9 +3767,10 @@ def do_count(db_name, options):
     return size, inserted, expired, missing
 
 def count(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options)
     tiles = tileset(options, db, db_filter=options.inside)
     n = tiles.size()
+    prefetch_tileset(db, tiles)
 
     inserted = 0
     expired = 0
@@ -1758,80 +3793,749 @@ def count(db_name, options):
 # -insert : download of tiles and insertion in database ----------------------
 
 def do_insert(db_name, options):
-    db = db_factory(db_name)
-    tiles = tileset(options, db, db_filter=options.inside)
+    db = db_factory(db_name, options)
+    with options.timer.phase('tileset'):
+        tiles = tileset(options, db, db_filter=options.inside)
     n = tiles.size()
+    with options.timer.phase('prefetch'):
+        prefetch_tileset(db, tiles)
 
-    counters = TileCounters()
+    session = InsertSession(db_name, db, options, n)
+    if options.resume:
+        session.journal.load()
 
-    for index, (x, y, zoom) in enumerate(tiles):
-        insert_tile(tiles, db, options, x, y, zoom, index, n, counters)
-    db.commit()
+    try:
+        download_and_store(session, insert_downloads(session, tiles))
+        retry_failures(session)
+    finally:
+        session.downloader.close()
+        # also on interruption, the journal must not record uncommitted tiles
+        with options.timer.phase('commit'):
+            session.writer.commit()
+            session.journal.save()
     if options.verbose:
         print('Commit.')
+    session.journal.close()
+    session.close_failures()
 
+    counters = session.counters
     display_report(options, ('Tiles in set', n),
+                            ('Done before', session.journal.resumed),
                             ('Already present', counters.ignored),
                             ('Inserted', counters.inserted),
-                            ('Missing', counters.missing))
-
-def insert_tile(tiles, db, options, x, y, zoom, index, n, counters):
-    exists_dst, date_dst = db.exists(x, y, zoom)
+                            ('Not modified', counters.revalidated),
+                            ('Missing', counters.missing),
+                            ('Failed', counters.failure),
+                            ('Connections', session.downloader.connections.opened),
+                            ('Requests', session.downloader.connections.requests))
+
+class InsertSession:
+    # helper class, state of an insertion
+    def __init__(self, db_name, db, options, size):
+        self.db = db
+        self.options = options
+        self.size = size
+        self.counters = TileCounters()
+        self.downloader = Downloader(options)
+        self.journal = InsertJournal(db_name, options, size)
+        self.failure_log = FailureLog(db_name)
+        self.failures = []
+        # tiles of failure log, and those of them completed by the session
+        self.logged = set(entry[:3] for entry in self.failure_log.read())
+        self.recovered = set()
+        self.pool = None
+        self.writer = TileWriter(db, options.database.commit_period)
+
+    def pending(self):
+        # number of downloads in progress
+        return 0 if self.pool is None else self.pool.pending
+
+    def complete(self, index, x, y, zoom):
+        # tile done, downloaded or not to be downloaded
+        self.journal.completed.add(index)
+        self.journal.failed.discard(index)
+        if (x, y, zoom) in self.logged:
+            self.recovered.add((x, y, zoom))
+
+    def close_failures(self):
+        # record tiles failed after all retries in failure log, entries of
+        # tiles completed by the session are dropped
+        failed = [((download.x, download.y, download.zoom), download) for download in self.failures]
+        keys = set(key for key, _ in failed)
+        entries = [entry for entry in self.failure_log.read()
+                   if entry[:3] not in self.recovered and entry[:3] not in keys]
+
+        for key, download in failed:
+            last_error = download.messages[-1] if download.messages else ''
+            entries.append(key + (download.url, last_error))
+        self.failure_log.write(entries)
+
+def insert_downloads(session, tiles):
+    # yield a download request for each tile to download
+    for index, (x, y, zoom) in session.journal.pending(tiles):
+        download = insert_check(session, x, y, zoom, index)
+        if download is not None:
+            yield download
+
+def download_and_store(session, downloads):
+    options, db = session.options, session.db
+
+    if options.insert.workers <= 1:
+        for download in downloads:
+            download_tile(options, db, session.downloader, download)
+            store_tile(session, download)
+    else:
+        # tiles are checked against the database and stored by the calling
+        # thread, only the downloads are done by the workers
+        session.pool = DownloadPool(options, db, session.downloader)
+        try:
+            for download in downloads:
+                session.pool.submit(download)
+                for done in session.pool.completed():
+                    store_tile(session, done)
+
+            for done in session.pool.completed(wait=True):
+                store_tile(session, done)
+        finally:
+            session.pool.close()
+            session.pool = None
+
+def retry_failures(session):
+    # failed tiles are tried again at the end of the session, waiting longer
+    # after each round
+    options = session.options
+    for retry in range(options.insert.retry_rounds):
+        if not session.failures:
+            break
+        downloads, session.failures = session.failures, []
+        delay = options.insert.retry_delay * 2 ** retry
+        if not options.quiet:
+            print('Retrying %d failed tiles in %.0f seconds.' % (len(downloads), delay))
+        sleep(delay)
+        for download in downloads:
+            download.reset()
+        download_and_store(session, downloads)
+
+    session.counters.failure = len(session.failures)
+
+def insert_check(session, x, y, zoom, index):
+    # return a download request if tile has to be downloaded, None otherwise
+    db, options, counters = session.db, session.options, session.counters
+    with options.timer.phase('exists'):
+        exists_dst, date_dst = db.exists(x, y, zoom)
     exists_src, date_src = True, None
 
     if not should_insert(options, exists_src, date_src, exists_dst, date_dst):
         counters.ignored += 1
-        tile_trace(options, x, y, zoom, index, n, 'already in database')
-    elif counters.inserted >= options.insert.session_max:
+        session.complete(index, x, y, zoom)
+        tile_trace(options, x, y, zoom, index, session.size, 'already in database')
+        return None
+    elif counters.inserted + session.pending() >= options.insert.session_max:
         counters.missing += 1
+        return None
     else:
-        sleep(options.insert.request_delay)
-
-        for i in range(options.insert.number_of_attempts):
-            url = tile_url(options, db, x, y, zoom)
-            try:
-                # no proxy handling...
-                u = requests.urlopen(url, timeout=options.insert.timeout)
-                tile_buffer = u.read()
-                u.close()
+        download = TileDownload(x, y, zoom, index, exists_dst)
+        if exists_dst and not options.force_insert:
+            # expired tile, ask the server to send it only if modified
+            download.validators = db.validators(x, y, zoom)
+        return download
+
+# download results
+FETCHED, NOT_FOUND, FAILED, NOT_MODIFIED = range(4)
+
+class TileDownload:
+    # helper class, download request and result
+    def __init__(self, x, y, zoom, index, exists_dst):
+        self.x = x
+        self.y = y
+        self.zoom = zoom
+        self.index = index
+        self.exists_dst = exists_dst
+        self.validators = (None, None)  # etag, last_modified
+        self.reset()
+
+    def reset(self):
+        self.url = None
+        self.status = FAILED
+        self.tile_buffer = None
+        self.messages = []
+
+def download_tile(options, db, downloader, download, stripe=None):
+    # fill download with tile buffer converted to database format, messages
+    # are kept in download to be traced by the caller
+    x, y, zoom = download.x, download.y, download.zoom
+    attempts = options.insert.number_of_attempts
+
+    headers = dict()
+    etag, last_modified = download.validators
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    for i in range(attempts):
+        url = tile_url(options, db, x, y, zoom, stripe)
+        download.url = url
+        try:
+            with options.timer.phase('throttle'):
+                downloader.limiter.wait(url)
+            with options.timer.phase('fetch'):
+                code, response, tile_buffer = downloader.connections.fetch(url, headers)
+            if code == 200:
+                download.validators = (response.getheader('ETag'),
+                                       response.getheader('Last-Modified'))
                 break
-            except urllib_error.HTTPError as e:
-                if e.code == 404:
-                    counters.missing += 1
-                    tile_trace(options, x, y, zoom, index, n, '%s : not found' % url)
-                    return
-                else:
-                    tile_trace(options, x, y, zoom, index, n, '%s : connection error %d - %d' % (url, i+1, e.code))
-            except Exception as e:
-                tile_trace(options, x, y, zoom, index, n, '%s : Exception connection error %d - %s' % (url, i+1, e))
-        else:
-            counters.missing += 1
-            return
+            elif code == 304:
+                download.status = NOT_MODIFIED
+                return download
+            elif code == 404:
+                download.status = NOT_FOUND
+                download.messages.append('%s : not found' % url)
+                return download
+            else:
+                download.messages.append('%s : connection error %d - %d' % (url, i+1, code))
+                if code in (429, 503):
+                    delay = retry_after_delay(response.getheader('Retry-After'))
+                    if delay is not None:
+                        # server driven, also delays other requests to host
+                        downloader.limiter.block(url, delay)
+                        continue
+        except Exception as e:
+            download.messages.append('%s : Exception connection error %d - %s' % (url, i+1, e))
 
-        if db.tile_format() == 'SERVER':
-            pass
-        else:
-            try:
+        if i + 1 < attempts:
+            sleep(backoff_delay(options, i))
+    else:
+        download.status = FAILED
+        return download
+
+    if db.tile_format() == 'SERVER':
+        pass
+    elif blob_format(tile_buffer) == db.tile_format() and blob_complete(tile_buffer):
+        # already in database format, store bytes as received
+        pass
+    else:
+        try:
+            with options.timer.phase('decode'):
                 tile_image = create_image_from_blob(tile_buffer)
+            with options.timer.phase('encode'):
                 tile_buffer = create_blob_from_image(tile_image,
                                                      db.tile_format(),
                                                      options.tiles.jpeg_quality)
-            except Exception as e:
-                tile_trace(options, x, y, zoom, index, n, 'image conversion error open ' + str(e))
-                counters.missing += 1
-                return
+        except Exception as e:
+            download.messages.append('image conversion error open ' + str(e))
+            download.status = FAILED
+            return download
+
+    download.tile_buffer = tile_buffer
+    download.status = FETCHED
+    return download
 
-        db.update(int(math.floor(time())), x, y, zoom, tile_buffer)
+def store_tile(session, download):
+    db, options, counters = session.db, session.options, session.counters
+    journal, n = session.journal, session.size
+    x, y, zoom, index = download.x, download.y, download.zoom, download.index
 
+    for msg in download.messages:
+        tile_trace(options, x, y, zoom, index, n, msg)
+
+    if download.status == FAILED:
+        # deferred to retry queue
+        journal.failed.add(index)
+        session.failures.append(download)
+        return
+    else:
+        session.complete(index, x, y, zoom)
+
+    if download.status == NOT_MODIFIED:
+        with options.timer.phase('update'):
+            db.touch(int(math.floor(time())), x, y, zoom)
+        counters.revalidated += 1
+        tile_trace(options, x, y, zoom, index, n, '%s : not modified' % download.url)
+    elif download.status == FETCHED:
+        with options.timer.phase('update'):
+            session.writer.update(int(math.floor(time())), x, y, zoom, download.tile_buffer)
+            if download.exists_dst or download.validators != (None, None):
+                db.update_validators(x, y, zoom, *download.validators)
         counters.inserted += 1
-        msg = 'updated' if exists_dst else 'inserted'
-        tile_trace(options, x, y, zoom, index, n, '%s : %s' % (url, msg))
-        if counters.inserted % options.database.commit_period == 0:
-            db.commit()
-            if options.verbose:
-                print('Commit.')
-
-def tile_url(options, db, x, y, zoom):
+        msg = 'updated' if download.exists_dst else 'inserted'
+        tile_trace(options, x, y, zoom, index, n, '%s : %s' % (download.url, msg))
+    else:
+        # not found
+        counters.missing += 1
+        return
+
+    if (counters.inserted + counters.revalidated) % options.database.commit_period == 0:
+        with options.timer.phase('commit'):
+            session.writer.commit()
+            journal.save()
+        if options.verbose:
+            print('Commit.')
+
+class FailureLog:
+    """
+    Tiles failed after all attempts and retries, saved next to the database,
+    one line for each tile: x, y, zoom, url and last error separated with
+    tabulations.
+    """
+    def __init__(self, db_name):
+        self.filename = os.path.normpath(db_name) + '.failures'
+
+    def read(self):
+        entries = []
+        if os.path.isfile(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    try:
+                        x, y, zoom = [int(v) for v in fields[:3]]
+                    except ValueError:
+                        continue
+                    url, last_error = (fields[3:5] + ['', ''])[:2]
+                    entries.append((x, y, zoom, url, last_error))
+        return entries
+
+    def write(self, entries):
+        if not entries:
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+            return
+        try:
+            with open(self.filename, 'w') as f:
+                for x, y, zoom, url, last_error in entries:
+                    last_error = re.sub(r'\s+', ' ', last_error)
+                    f.write('%d\t%d\t%d\t%s\t%s\n' % (x, y, zoom, url, last_error))
+        except IOError:
+            error('unable to write ' + self.filename)
+
+class IndexRanges:
+    # helper class, set of integers stored as a sorted list of [start, end)
+    def __init__(self, ranges=()):
+        self.ranges = [list(r) for r in ranges]
+
+    def __contains__(self, index):
+        i = bisect.bisect_right(self.ranges, [index, sys.maxsize])
+        return i > 0 and index < self.ranges[i - 1][1]
+
+    def __len__(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def add(self, index):
+        ranges = self.ranges
+        if ranges and ranges[-1][1] == index:
+            # most frequent case, tiles are handled in sequence
+            ranges[-1][1] += 1
+            return
+
+        i = bisect.bisect_right(ranges, [index, sys.maxsize])
+        if i > 0 and index < ranges[i - 1][1]:
+            return
+        merge_prev = i > 0 and ranges[i - 1][1] == index
+        merge_next = i < len(ranges) and ranges[i][0] == index + 1
+        if merge_prev and merge_next:
+            ranges[i - 1][1] = ranges[i][1]
+            del ranges[i]
+        elif merge_prev:
+            ranges[i - 1][1] += 1
+        elif merge_next:
+            ranges[i][0] = index
+        else:
+            ranges.insert(i, [index, index + 1])
+
+    def discard(self, index):
+        ranges = self.ranges
+        i = bisect.bisect_right(ranges, [index, sys.maxsize])
+        if i == 0 or index >= ranges[i - 1][1]:
+            return
+        start, end = ranges[i - 1]
+        if start == index and end == index + 1:
+            del ranges[i - 1]
+        elif start == index:
+            ranges[i - 1][0] += 1
+        elif end == index + 1:
+            ranges[i - 1][1] -= 1
+        else:
+            ranges[i - 1][1] = index
+            ranges.insert(i, [index + 1, end])
+
+    def first_missing(self):
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        else:
+            return 0
+
+class InsertJournal:
+    """
+    Progress of an insertion session, saved next to the database. Tiles are
+    identified by their index in the tile set which is generated in the same
+    order from one run to the other. Completed and failed tiles are recorded
+    as ranges of indexes. A session resumed from the journal skips completed
+    tiles without generating their requests to the database.
+    """
+    def __init__(self, db_name, options, size):
+        self.filename = os.path.normpath(db_name) + '.journal'
+        signature = '%s;%d;%s' % (os.path.abspath(db_name), size, tileset_signature(options))
+        self.key = hashlib.sha1(signature.encode('utf-8')).hexdigest()
+        self.size = size
+        self.completed = IndexRanges()
+        self.failed = IndexRanges()
+        self.resumed = 0
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                journal = json.load(f)
+        except (IOError, ValueError):
+            print('No journal to resume from, starting from first tile.')
+            return
+
+        if journal.get('key') != self.key:
+            print('Journal does not match tile set, starting from first tile.')
+        else:
+            # failed tiles are tried again
+            self.completed = IndexRanges(journal['completed'])
+            self.resumed = len(self.completed)
+
+    def pending(self, tiles):
+        # yield (index, tile) for tiles not completed
+        start = self.completed.first_missing()
+        for index, tile in enumerate(itertools.islice(tiles, start, None), start):
+            if index not in self.completed:
+                yield index, tile
+
+    def save(self):
+        journal = {'key': self.key,
+                   'completed': self.completed.ranges,
+                   'failed': self.failed.ranges}
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump(journal, f)
+        except IOError:
+            error('unable to write ' + self.filename)
+
+    def close(self):
+        # nothing left to resume if all tiles are completed
+        if len(self.completed) == self.size and os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+def tileset_signature(options):
+    # string identifying the tile set definition, including the date of the
+    # source file
+    fields = ('track', 'tracks', 'contour', 'contours', 'project', 'db_tiles',
+              'coord_tiles', 'failed_tiles', 'zoom', 'zoom_limit', 'radius',
+              'inside', 'order')
+    signature = [repr(getattr(options, field, None)) for field in fields]
+    source = options.tile_source
+    if isinstance(source, six.string_types) and os.path.isfile(source):
+        signature.append(repr(os.path.getmtime(source)))
+    return ';'.join(signature)
+
+class DownloadPool:
+    """
+    Download tiles with a pool of worker threads. The number of simultaneous
+    downloads is limited for each host of the url template (one host for each
+    [abc] stripe). Results are returned to the calling thread which is the
+    only one to access the database.
+    """
+    def __init__(self, options, db, downloader):
+        self.options = options
+        self.db = db
+        self.downloader = downloader
+        self.pending = 0
+        self.jobs = queue.Queue(maxsize=4 * options.insert.workers)
+        self.results = queue.Queue()
+
+        # one semaphore per host, shared by stripes targeting the same host
+        self.stripes = []
+        semaphores = dict()
+        for stripe in tile_stripes(db):
+            host = url_host(tile_url(options, db, 0, 0, 0, stripe))
+            if host not in semaphores:
+                semaphores[host] = threading.BoundedSemaphore(max(1, options.insert.host_connections))
+            self.stripes.append((stripe, semaphores[host]))
+
+        self.threads = []
+        for _ in range(options.insert.workers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, download):
+        self.jobs.put(download)
+        self.pending += 1
+
+    def completed(self, wait=False):
+        # yield available results, or all pending results if wait is True
+        while self.pending > 0:
+            try:
+                download = self.results.get(block=wait)
+            except queue.Empty:
+                return
+            self.pending -= 1
+            yield download
+
+    def close(self):
+        # drop waiting jobs (on interruption) and stop workers
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join(self.options.insert.timeout)
+
+    def acquire_stripe(self):
+        # take a stripe whose host is free, or wait for a random one
+        stripes = list(self.stripes)
+        random.shuffle(stripes)
+        for stripe, semaphore in stripes:
+            if semaphore.acquire(False):
+                return stripe, semaphore
+        stripe, semaphore = stripes[0]
+        semaphore.acquire()
+        return stripe, semaphore
+
+    def worker(self):
+        while True:
+            download = self.jobs.get()
+            if download is None:
+                return
+            stripe, semaphore = self.acquire_stripe()
+            try:
+                download_tile(self.options, self.db, self.downloader, download, stripe)
+            except Exception as e:
+                download.status = FAILED
+                download.messages.append('download error %s' % e)
+            finally:
+                semaphore.release()
+            self.results.put(download)
+
+class ConnectionPool:
+    """
+    Persistent HTTP/1.1 connections to tile servers. Idle connections are kept
+    for each host and reused for the whole session. Counts connections opened
+    and requests served. Proxies are taken from the environment (http_proxy,
+    https_proxy and no_proxy), https requests go through a CONNECT tunnel.
+    """
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.idle = dict()  # (scheme, host) -> list of idle connections
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+        self.proxies = requests.getproxies()
+        self.routes = dict()  # (scheme, host) -> (proxy host, proxy headers) or None
+
+    def route(self, key):
+        # return proxy host and headers to reach host, None if direct
+        with self.lock:
+            if key in self.routes:
+                return self.routes[key]
+        scheme, host = key
+        proxy = self.proxies.get(scheme)
+        if proxy is None or requests.proxy_bypass(host):
+            route = None
+        else:
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            parts = urllib_parse.urlsplit(proxy)
+            headers = dict()
+            if parts.username is not None:
+                credentials = '%s:%s' % (urllib_parse.unquote(parts.username),
+                                         urllib_parse.unquote(parts.password or ''))
+                headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+            route = parts.netloc.rpartition('@')[2], headers
+        with self.lock:
+            self.routes[key] = route
+        return route
+
+    def acquire(self, key):
+        # return an idle connection to host or a new one, and True if reused
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+            self.opened += 1
+
+        scheme, host = key
+        route = self.route(key)
+        if route is not None:
+            proxy, headers = route
+            if scheme == 'https':
+                connection = http_client.HTTPSConnection(proxy, timeout=self.timeout)
+                connection.set_tunnel(host, headers=headers)
+                return connection, False
+            else:
+                return http_client.HTTPConnection(proxy, timeout=self.timeout), False
+        elif scheme == 'https':
+            return http_client.HTTPSConnection(host, timeout=self.timeout), False
+        else:
+            return http_client.HTTPConnection(host, timeout=self.timeout), False
+
+    def release(self, key, connection):
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+
+    def fetch(self, url, headers=None):
+        # return http status, response and content of url, follow redirections
+        for _ in range(self.MAX_REDIRECTS):
+            code, response, content = self.request(url, headers)
+            location = response.getheader('Location')
+            if code in (301, 302, 303, 307, 308) and location:
+                url = urllib_parse.urljoin(url, location)
+            else:
+                break
+        return code, response, content
+
+    def request(self, url, headers=None):
+        parts = urllib_parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or ())
+        headers['User-Agent'] = '%s/%s' % (APPNAME, VERSION)
+        route = self.route(key)
+        if route is not None and parts.scheme == 'http':
+            # plain http proxies are given the whole url
+            path = url
+            headers.update(route[1])
+
+        while True:
+            connection, reused = self.acquire(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except Exception:
+                connection.close()
+                if reused:
+                    # keep-alive connection closed by server, try a new one
+                    continue
+                raise
+
+        with self.lock:
+            self.requests += 1
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(key, connection)
+
+        return response.status, response, content
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = dict()
+
+class TokenBucket:
+    """
+    Allow rate requests per second on average with bursts of at most burst
+    requests. A rate of 0 gives no limit. The bucket may also be blocked for
+    some time (server asking to slow down).
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.stamp = time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        # take a token and return the delay to wait before using it
+        with self.lock:
+            now = time()
+            delay = 0
+            if self.rate > 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = -self.tokens / self.rate
+            return max(delay, self.blocked_until - now)
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time() + seconds)
+
+class RateLimiter:
+    """
+    Global and per host request budgets.
+    """
+    def __init__(self, rate, host_rate):
+        self.bucket = TokenBucket(rate)
+        self.host_rate = host_rate
+        self.host_buckets = dict()
+        self.lock = threading.Lock()
+
+    def host_bucket(self, url):
+        host = url_host(url)
+        with self.lock:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = TokenBucket(self.host_rate)
+            return self.host_buckets[host]
+
+    def wait(self, url):
+        delay = max(self.bucket.delay(), self.host_bucket(url).delay())
+        if delay > 0:
+            sleep(delay)
+
+    def block(self, url, seconds):
+        self.host_bucket(url).block(seconds)
+
+class Downloader:
+    # helper class, network resources shared by the downloads of a session
+    def __init__(self, options):
+        self.connections = ConnectionPool(options.insert.timeout)
+        self.limiter = RateLimiter(options.insert.max_rate, options.insert.host_max_rate)
+
+    def close(self):
+        self.connections.close()
+
+def backoff_delay(options, attempt):
+    # exponential backoff with full jitter
+    delay = min(options.insert.backoff_max, options.insert.backoff_delay * 2 ** attempt)
+    return random.uniform(0, delay)
+
+def retry_after_delay(value):
+    # decode Retry-After header, either a number of seconds or a http date
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time())
+    except Exception:
+        return None
+
+def tile_stripes(db):
+    # return the list of stripes of url template, [None] if no stripes
+    template = db.url_template()
+    if template is None or template == '':
+        error('unknown server url template, use -describe to supply.')
+
+    m = re.search(r'\[(.*)\]', template)
+    if m:
+        return list(m.group(1))
+    else:
+        return [None]
+
+def url_host(url):
+    return urllib_parse.urlparse(url).netloc
+
+def tile_url(options, db, x, y, zoom, stripe=None):
     template = db.url_template()
     if template is None or template == '':
         error('unknown server url template, use -describe to supply.')
@@ -1845,7 +4549,9 @@ def tile_url(options, db, x, y, zoom):
     m = re.search(r'\[(.*)\]', template)
     if m:
         stripes = m.group(1)
-        url = url.replace('[' + stripes + ']', stripes[random.randint(0, len(stripes) - 1)])
+        if stripe is None:
+            stripe = stripes[random.randint(0, len(stripes) - 1)]
+        url = url.replace('[' + stripes + ']', stripe)
 
     return url
 
@@ -1855,28 +4561,41 @@ def do_import(db_name, options):
     if options.db_source is None:
         error('source database must be given')
 
-    db_arg = db_factory(db_name)
-    db_src = db_factory(options.db_source)
-    tiles = tileset(options, db_arg, db_filter=options.inside)
+    db_arg = db_factory(db_name, options)
+    db_src = db_factory(options.db_source, options)
+    with options.timer.phase('tileset'):
+        tiles = tileset(options, db_arg, db_filter=options.inside)
 
     import_tiles(options, db_src, db_arg, tiles)
 
 def import_tiles(options, db_src, db_dst, tiles):
     n = tiles.size()
     counters = TileCounters()
+    with options.timer.phase('prefetch'):
+        prefetch_tileset(db_src, tiles)
+        prefetch_tileset(db_dst, tiles)
+
+    # tiles are copied as stored when nothing is drawn on them and both
+    # databases use the same format
+    passthrough = (not options.Import.draw_tile_width and
+                   not options.Import.draw_tile_limits and
+                   db_src.tile_format() == db_dst.tile_format())
 
+    writer = TileWriter(db_dst, options.database.commit_period)
     for index, (x, y, zoom) in enumerate(tiles):
-        import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src)
-    db_dst.commit()
+        import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src, writer, passthrough)
+    with options.timer.phase('commit'):
+        writer.commit()
 
     display_report(options, ('Tiles in set', n),
                             ('Already present', counters.ignored),
                             ('Inserted', counters.inserted),
                             ('Missing', counters.missing))
 
-def import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src):
-    exists_dst, date_dst = db_dst.exists(x, y, zoom)
-    exists_src, date_src = db_src.exists(x, y, zoom)
+def import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src, writer, passthrough):
+    with options.timer.phase('exists'):
+        exists_dst, date_dst = db_dst.exists(x, y, zoom)
+        exists_src, date_src = db_src.exists(x, y, zoom)
 
     if not exists_src:
         counters.missing += 1
@@ -1888,20 +4607,52 @@ def import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src):
         tile_trace(options,x, y, zoom, index, n, 'source ignored')
         return
 
-    # retrieve from source, tile is a PIL image
-    exists_src, date_src, tile = db_src.retrieve(x, y, zoom)
+    # retrieve from source
+    with options.timer.phase('retrieve'):
+        exists_src, date_src, tile_buffer = db_src.retrieve_buffer(x, y, zoom)
 
-    if exists_src is None:
+    if not exists_src:
         counters.missing += 1
         tile_trace(options, x, y, zoom, index, n, 'source unreadable')
         return
 
+    if passthrough and blob_format(tile_buffer) == db_dst.tile_format():
+        # already in destination format, store bytes as read
+        tile = tile_buffer
+    else:
+        tile = transcode_tile(db_dst, x, y, zoom, options, date_src, tile_buffer)
+        if tile is None:
+            counters.missing += 1
+            tile_trace(options, x, y, zoom, index, n, 'source unreadable')
+            return
+
+    with options.timer.phase('update'):
+        writer.update(date_src, x, y, zoom, tile)
+    if index % options.database.commit_period == 0:
+        with options.timer.phase('commit'):
+            writer.commit()
+
+    counters.inserted += 1
+    if exists_dst:
+        tile_trace(options, x, y, zoom, index, n, 'updated')
+    else:
+        tile_trace(options, x, y, zoom, index, n, 'inserted')
+
+def transcode_tile(db_dst, x, y, zoom, options, date_src, tile_buffer):
+    # return tile buffer in destination format with requested drawings, None
+    # if the source image cannot be decoded
+    with options.timer.phase('decode'):
+        try:
+            tile = create_image_from_blob(tile_buffer)
+            tile = tile.convert('RGBA')
+        except:
+            return None
+
     # prepare drawing
     if date_src is not None and date_src > options.database.expiry_date:
         color = options.tiles.border_valid_color
     else:
         color = options.tiles.border_expired_color
-    tile = tile.convert('RGBA')
 
     # draw tile width if requested
     if options.Import.draw_tile_width:
@@ -1912,17 +4663,8 @@ def import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src):
         tile = draw_alpha_border(tile, color)
 
     # convert to destination tile format
-    tile = create_blob_from_image(tile, db_dst.tile_format(), options.tiles.jpeg_quality)
-
-    db_dst.update(date_src, x, y, zoom, tile)
-    if index % options.database.commit_period == 0:
-        db_dst.commit()
-
-    counters.inserted += 1
-    if exists_dst:
-        tile_trace(options, x, y, zoom, index, n, 'updated')
-    else:
-        tile_trace(options, x, y, zoom, index, n, 'inserted')
+    with options.timer.phase('encode'):
+        return create_blob_from_image(tile, db_dst.tile_format(), options.tiles.jpeg_quality)
 
 # -export : export tiles to tile database ------------------------------------
 
@@ -1934,8 +4676,8 @@ def do_export(db_name, options):
     if options.db_dest is None:
         error('destination database must be given')
 
-    db_arg = db_factory(db_name)
-    db_dst = db_factory(options.db_dest)
+    db_arg = db_factory(db_name, options)
+    db_dst = db_factory(options.db_dest, options)
     tiles = tileset(options, db_arg, db_filter=options.inside)
 
     import_tiles(options, db_arg, db_dst, tiles)
@@ -1943,17 +4685,18 @@ def do_export(db_name, options):
 # -delete: delete tiles from database ----------------------------------------
 
 def do_delete(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options)
     tiles = tileset(options, db, db_filter=options.inside)
 
     size = tiles.size()
     counters = TileCounters()
+    prefetch_tileset(db, tiles)
 
     for index, (x, y, zoom) in enumerate(tiles):
         delete_tile(tiles, db, x, y, zoom, options, index, size, counters)
 
     db.commit()
-    db.pack()
+    db.reclaim(options.database.pack_threshold, options.database.pack_pages)
 
     display_report(options, ('Tiles in set', size),
                             ('Deleted', counters.deleted),
@@ -1980,7 +4723,7 @@ def delete_tile(tiles, db, x, y, zoom, options, index, size, counters):
 # -view : make image from gpx ------------------------------------------------
 
 def do_makeview(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options)
 
     generator, source, zoom, radius = options_generate(options)
     if len(zoom) > 1:
@@ -2145,9 +4888,9 @@ class HTTPServerLayer(object):
     host = '127.0.0.1'
     port = 80
 
-    def start_server(self, db_name):
+    def start_server(self, db_name, options=None):
         global db
-        db = db_factory(db_name)
+        db = db_factory(db_name, options)
         self.server = HTTPServerBest((self.host, self.port), TileServerHTTPRequestHandler)
         self.server_thread = threading.Thread(
             target=self.server.serve_until_shutdown)
@@ -2166,7 +4909,7 @@ class HTTPServerLayer(object):
 
 def do_server(db_name, port, options):
     server = kahelo.HTTPServerLayer()
-    server.start_server(db_name)
+    server.start_server(db_name, options)
     return server
 
 def stop_server(server):
@@ -2206,65 +4949,121 @@ class TileServerHTTPRequestHandler(BaseHTTPRequestHandler):
 
 
 def do_statistics(db_name, options):
-    db = db_factory(db_name)
-    tiles = tileset(options, db, db_filter=options.inside)
-    n = tiles.size()
-
-    maxzoomp1 = MAXZOOM + 1
-    sizes = []
-    size = [[] for _ in range(maxzoomp1)]
-    xmin = [2 ** maxzoomp1] * maxzoomp1
-    ymin = [2 ** maxzoomp1] * maxzoomp1
-    xmax = [0] * maxzoomp1
-    ymax = [0] * maxzoomp1
-
-    for index, (x, y, zoom) in enumerate(tiles):
-        exists, date, buffer = db.retrieve_buffer(x, y, zoom)
-        if exists:
-            sizes.append(len(buffer))
-            size[zoom].append(len(buffer))
-            if x < xmin[zoom]: xmin[zoom] = x
-            if y < ymin[zoom]: ymin[zoom] = y
-            if x > xmax[zoom]: xmax[zoom] = x
-            if y > ymax[zoom]: ymax[zoom] = y
-            tile_trace(options, x, y, zoom, index, n, 'counted')
-        else:
-            pass
+    db = db_factory(db_name, options)
+    zoom_stats = db.zoom_stats() if options.db_tiles and not options.radius else None
+    if zoom_stats is not None:
+        # whole zoom levels are answered from statistics of database
+        zooms = options_generate(options)[2]
+        zoom_stats = dict((zoom, zoom_stats[zoom]) for zoom in zooms if zoom in zoom_stats)
+    else:
+        zoom_stats = tileset_stats(db, options)
 
-    display_report(options)
+    stats = db.dedup_stats()
+    if stats is None or stats[1] == 0:
+        display_report(options)
+    else:
+        # for the whole database
+        tiles_stored, images_stored = stats
+        display_report(options, ('Tiles stored', tiles_stored),
+                                ('Images stored', images_stored),
+                                ('Dedup ratio', '%.2f' % (float(tiles_stored) / images_stored)))
     print('-' * 29)
     print('%4s %6s %6s %6s %8s %12s (sizes in byte)' % ('zoom', 'count', 'min', 'max', 'average', 'total'))
 
-    for zoom in [z for z,v in enumerate(size) if len(v) > 0]:
-        slen  = decsep(len(size[zoom]))
-        smin  = decsep(min(size[zoom]))
-        smax  = decsep(max(size[zoom]))
-        smean = decsep(sum(size[zoom]) // len(size[zoom]))
-        stot  = decsep(sum(size[zoom]))
+    zooms = sorted(zoom_stats)
+    for zoom in zooms:
+        count, total, size_min, size_max = zoom_stats[zoom][:4]
+        slen  = decsep(count)
+        smin  = decsep(size_min)
+        smax  = decsep(size_max)
+        smean = decsep(total // count)
+        stot  = decsep(total)
         print('%4d %6s %6s %6s %8s %12s' % (zoom, slen, smin, smax, smean, stot))
 
-    if len(sizes) == 0:
+    if len(zooms) == 0:
         slen, smin, smax, smean, stot = [0] * 5
     else:
-        slen  = decsep(len(sizes))
-        smin  = decsep(min(sizes))
-        smax  = decsep(max(sizes))
-        smean = decsep(sum(sizes) // len(sizes))
-        stot  = decsep(sum(sizes))
+        count = sum(zoom_stats[zoom][0] for zoom in zooms)
+        total = sum(zoom_stats[zoom][1] for zoom in zooms)
+        slen  = decsep(count)
+        smin  = decsep(min(zoom_stats[zoom][2] for zoom in zooms))
+        smax  = decsep(max(zoom_stats[zoom][3] for zoom in zooms))
+        smean = decsep(total // count)
+        stot  = decsep(total)
     print('%4s %6s %6s %6s %8s %12s' % ('all', slen, smin, smax, smean, stot))
     print('-' * 29)
 
     print('%4s %6s %6s %6s %6s (boxing area in tile units)' % ('zoom', 'x min', 'y min', 'x max', 'y max'))
-    for zoom in [z for z,v in enumerate(xmin) if v < 2 ** maxzoomp1]:
-        print('%4d %6d %6d %6d %6d' % (zoom, xmin[zoom], ymin[zoom], xmax[zoom], ymax[zoom]))
+    for zoom in zooms:
+        xmin, ymin, xmax, ymax = zoom_stats[zoom][6:]
+        print('%4d %6d %6d %6d %6d' % (zoom, xmin, ymin, xmax, ymax))
 
     print('-' * 29)
     print('%4s %11s %11s %11s %11s (boxing area in degrees)' % ('zoom', 'lat min', 'long min', 'lat max', 'long max'))
-    for zoom in [z for z,v in enumerate(xmin) if v < 2 ** maxzoomp1]:
-        lat_min, lon_min = tile2deg(xmin[zoom], ymin[zoom], zoom)
-        lat_max, lon_max = tile2deg(xmax[zoom], ymax[zoom], zoom)
+    for zoom in zooms:
+        xmin, ymin, xmax, ymax = zoom_stats[zoom][6:]
+        lat_min, lon_min = tile2deg(xmin, ymin, zoom)
+        lat_max, lon_max = tile2deg(xmax, ymax, zoom)
         print('%4d %11.6f %11.6f %11.6f %11.6f' % (zoom, lat_min, lon_min, lat_max, lon_max))
 
+def tileset_stats(db, options):
+    # statistics of the tiles of tile set stored in database
+    tiles = tileset(options, db, db_filter=options.inside)
+    n = tiles.size()
+    stats = dict()
+
+    for index, (x, y, zoom) in enumerate(tiles):
+        exists, date, buffer = db.retrieve_buffer(x, y, zoom)
+        if exists:
+            stats_add(stats, zoom, x, y, date, len(buffer))
+            tile_trace(options, x, y, zoom, index, n, 'counted')
+        else:
+            pass
+
+    return stats
+
+# -migrate : conversion to latest database format ----------------------------
+
+def do_migrate(db_name, options):
+    db = db_factory(db_name, options)
+    if not isinstance(db, KaheloDatabase):
+        error('only kahelo databases can be migrated')
+    elif isinstance(db, Kahelo2Database):
+        n = 0
+        if not options.quiet:
+            print('Database already in latest format.')
+    else:
+        n = db.migrate()
+        db.close()
+        db = db_factory(db_name, options)
+        db.rebuild_stats()
+        if db.dedup:
+            db.deduplicate()
+        # reclaim space of version 1 table
+        db.pack()
+    db.close()
+
+    display_report(options, ('Tiles migrated', n))
+
+# -pack : full compaction of database ----------------------------------------
+
+def do_pack(db_name, options):
+    db = db_factory(db_name, options)
+    db.pack()
+    db.close()
+
+    display_report(options)
+
+# -rebuild : statistics of tiles stored --------------------------------------
+
+def do_rebuild(db_name, options):
+    db = db_factory(db_name, options)
+    db.rebuild_stats()
+    n = sum(s[0] for s in db.zoom_stats().values())
+    db.close()
+
+    display_report(options, ('Tiles stored', n))
+
 # -- Image and drawing helpers -----------------------------------------------
 
 def create_image_from_blob(blob):
@@ -2274,6 +5073,30 @@ def create_image_from_blob(blob):
     else:
         return Image.open(io.BytesIO(blob))
 
+def blob_format(blob):
+    # return the image format of blob ('JPG' or 'PNG') from its magic bytes,
+    # None if not recognized
+    head = bytes(blob[:8])
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    elif head.startswith(b'\xff\xd8\xff'):
+        return 'JPG'
+    else:
+        return None
+
+def blob_complete(blob):
+    # return True if blob ends like a complete png or jpeg image, a cheap
+    # check against truncated downloads without decoding
+    tail = bytes(blob[-16:])
+    image_format = blob_format(blob)
+    if image_format == 'PNG':
+        return tail.endswith(b'IEND\xaeB`\x82')
+    elif image_format == 'JPG':
+        # end of image marker, possibly followed by padding
+        return b'\xff\xd9' in tail
+    else:
+        return False
+
 def create_blob_from_image(img, format, jpeg_quality=85):
     # img is a PIL image
     # return buffer of image with requested format
@@ -2424,6 +5247,7 @@ def kahelo(argstring=None):
         options = ArgumentParser().parse_args(argstring)
         read_config(options)
         options.start_time = start
+        options.timer = PhaseTimer(options.timings is not None)
         r = apply_command(options)
         return r
     except KeyboardInterrupt:
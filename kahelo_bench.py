@@ -0,0 +1,192 @@
+"""
+Benchmarks for kahelo.
+$ ./kahelo_bench.py [tiles per side]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+
+import six.moves.builtins as builtins
+
+from kahelo import kahelo
+
+
+ZOOM = 14
+
+
+def main():
+    if len(sys.argv) > 2:
+        print(__doc__)
+        exit(1)
+
+    side = int(sys.argv[1]) if len(sys.argv) == 2 else 64
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bench_tile_order(tmpdir, side)
+        bench_syscalls(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+# Helpers
+
+
+def tile_buffer():
+    img = kahelo.Image.new('RGB', (256, 256))
+    img.putdata([(random.randint(0, 255), 128, 64) for _ in range(256 * 256)])
+    return kahelo.create_blob_from_image(img, 'PNG')
+
+
+def tile_block(side):
+    x0, y0 = 8000, 5600
+    return [(x, y, ZOOM) for x in range(x0, x0 + side) for y in range(y0, y0 + side)]
+
+
+def ordered(tiles, order):
+    if order == 'none':
+        # order of tile sets generated through python sets
+        tiles = list(tiles)
+        random.shuffle(tiles)
+        return tiles
+    else:
+        tile_set = kahelo.TileSet(iter(tiles), len(tiles))
+        tile_set.order(order)
+        return list(tile_set)
+
+
+def create_db(tmpdir, db_format):
+    db_name = os.path.join(tmpdir, 'bench-%s.db' % db_format)
+    kahelo.DatabaseProperties(db_name).set(db_format.upper(), 'PNG', '')
+    return db_name
+
+
+def remove_db(db_name):
+    if os.path.isdir(db_name):
+        shutil.rmtree(db_name)
+    elif os.path.isfile(db_name):
+        os.remove(db_name)
+    # statistics and manifest of folder databases
+    for ext in ('.stats', '.manifest'):
+        if os.path.isfile(db_name + ext):
+            os.remove(db_name + ext)
+
+
+# Benchmarks
+
+
+def bench_tile_order(tmpdir, side):
+    random.seed(0)
+    buffer = tile_buffer()
+    tiles = tile_block(side)
+
+    print('%d tiles, time in seconds' % len(tiles))
+    print('%-10s %-8s %8s %8s' % ('db', 'order', 'update', 'retrieve'))
+
+    for db_format in ('kahelo', 'rmaps', 'folder', 'maverick', 'bundle'):
+        db_name = create_db(tmpdir, db_format)
+        for order in ('none', 'hilbert', 'zorder'):
+            remove_db(db_name)
+            tiles_ordered = ordered(tiles, order)
+            db = kahelo.db_factory(db_name)
+
+            t0 = time.time()
+            for index, (x, y, zoom) in enumerate(tiles_ordered):
+                db.update(None, x, y, zoom, buffer)
+                if index % 100 == 0:
+                    db.commit()
+            db.commit()
+            t1 = time.time()
+            for x, y, zoom in tiles_ordered:
+                db.retrieve_buffer(x, y, zoom)
+            t2 = time.time()
+
+            db.close()
+            print('%-10s %-8s %8.3f %8.3f' % (db_format, order, t1 - t0, t2 - t1))
+        remove_db(db_name)
+
+
+# file system calls counted by bench_syscalls, os.path functions and
+# os.makedirs are counted through the calls they make
+SYSCALLS = ('stat', 'fstat', 'mkdir', 'utime', 'remove', 'listdir')
+
+
+class SyscallCounter:
+    """Count calls to file system functions while active."""
+
+    def __init__(self):
+        self.count = 0
+        self.saved = []
+
+    def counting(self, module, name):
+        function = getattr(module, name)
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return function(*args, **kwargs)
+        self.saved.append((module, name, function))
+        setattr(module, name, wrapper)
+
+    def __enter__(self):
+        self.count = 0
+        for name in SYSCALLS:
+            self.counting(os, name)
+        self.counting(builtins, 'open')
+        return self
+
+    def __exit__(self, *args):
+        for module, name, function in self.saved:
+            setattr(module, name, function)
+        self.saved = []
+
+
+def bench_syscalls(tmpdir):
+    buffer = tile_buffer()
+    tiles = tile_block(8)
+    operations = (
+        ('insert', lambda db, x, y, zoom: db.update(None, x, y, zoom, buffer)),
+        ('replace', lambda db, x, y, zoom: db.update(None, x, y, zoom, buffer)),
+        ('exists', lambda db, x, y, zoom: db.exists(x, y, zoom)),
+        ('retrieve', lambda db, x, y, zoom: db.retrieve_buffer(x, y, zoom)),
+        ('delete', lambda db, x, y, zoom: db.delete(x, y, zoom)),
+        ('missing', lambda db, x, y, zoom: db.exists(x, y, zoom)))
+
+    print()
+    print('file system calls per tile, %d tiles' % len(tiles))
+    print('%-10s %-9s %-6s' % ('db', 'manifest', 'stats') + ''.join('%9s' % name for name, _ in operations))
+
+    for db_format in ('folder', 'maverick'):
+        for manifest, stats in ((False, False), (False, True), (True, True)):
+            db_name = create_db(tmpdir, db_format)
+            remove_db(db_name)
+            if not manifest:
+                # existing folder without manifest, statistics rebuilt when
+                # maintained
+                os.mkdir(db_name)
+                if stats:
+                    db = kahelo.db_factory(db_name)
+                    db.rebuild_stats()
+                    db.commit()
+                    db.close()
+                    if os.path.isfile(db_name + '.manifest'):
+                        os.remove(db_name + '.manifest')
+            db = kahelo.db_factory(db_name)
+            counts = []
+            for _, operation in operations:
+                with SyscallCounter() as counter:
+                    for x, y, zoom in tiles:
+                        operation(db, x, y, zoom)
+                    db.commit()
+                counts.append(float(counter.count) / len(tiles))
+            db.close()
+            remove_db(db_name)
+            print('%-10s %-9s %-6s' % (db_format, manifest, stats) + ''.join('%9.2f' % count for count in counts))
+    print('counted: %s, open' % ', '.join(SYSCALLS))
+    print('statistics without manifest stat the tile file before each write or delete')
+
+if __name__ == '__main__':
+    main()
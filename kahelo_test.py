@@ -10,6 +10,14 @@ import sys
 import shutil
 import subprocess
 import time 
+import json
+import io
+import threading
+import re
+import email.utils
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
 
 from kahelo import kahelo
 
@@ -63,8 +71,8 @@ def main():
     try:
         define_tile_sets()
 
-        for db1 in ('kahelo', 'rmaps', 'folder', 'maverick'):
-            for db2 in ('kahelo', 'rmaps', 'folder', 'maverick'):
+        for db1 in ('kahelo', 'rmaps', 'mbtiles', 'folder', 'maverick', 'bundle'):
+            for db2 in ('kahelo', 'rmaps', 'mbtiles', 'folder', 'maverick', 'bundle'):
                 print('---', db1, db2)
                 test_db(url, db1, 'server', db2, 'png', trace='-verbose') # jpg
         
@@ -78,6 +86,31 @@ def main():
         test_contours()
         test_tile_coords(db_name)
         test_zoom_subdivision(url)
+        test_concurrent_insert(url)
+        test_insert_passthrough(url)
+        test_import_passthrough()
+        test_insert_resume(url)
+        test_failure_log()
+        test_connection_reuse()
+        test_rate_limits()
+        test_conditional_get()
+        test_truncated_download()
+        test_timings(url)
+        test_batched_update()
+        test_sqlite_pragmas(url)
+        test_migrate(url)
+        test_dedup()
+        test_mbtiles()
+        test_tile_box()
+        test_tile_order()
+        test_iter_tiles()
+        test_prefetch()
+        test_zoom_stats()
+        test_connection_pool()
+        test_pack()
+        test_scan_folder()
+        test_folder_manifest()
+        test_bundle()
 
         if test_result is True:
             print('All tests ok.')
@@ -194,8 +227,76 @@ def remove_db(db):
         shutil.rmtree(db)
     else:
         pass
-    if os.path.isfile(db + '.properties'):
-        os.remove(db + '.properties')
+    for ext in ('.properties', '.stats', '.manifest', '-wal', '-shm'):
+        if os.path.isfile(db + ext):
+            os.remove(db + ext)
+
+
+class ScriptedTileServer(ThreadingMixIn, HTTPServer):
+    """
+    Tile server for download tests, serving the same png image for all
+    tiles at /zoom/x/y.png with keep-alive connections and validators.
+    Tiles may be set to fail or to be truncated, /redirect/zoom/x/y.png
+    redirects to the tile.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ScriptedTileHandler)
+        self.url = 'http://127.0.0.1:%d/{zoom}/{x}/{y}.png' % self.server_address[1]
+        self.tile = kahelo.create_blob_from_image(kahelo.Image.new('RGB', (256, 256), (0, 128, 255)), 'PNG')
+        self.failing = set()
+        self.truncated = set()
+        self.connections = 0
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class ScriptedTileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.server.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('If-None-Match')))
+        # absolute url when used as proxy
+        m = re.search(r'/(redirect/)?(\d+)/(\d+)/(\d+)\.png$', self.path)
+        if not m:
+            return self.reply(404)
+        zoom, x, y = int(m.group(2)), int(m.group(3)), int(m.group(4))
+        if m.group(1):
+            return self.reply(302, headers=[('Location', '/%d/%d/%d.png' % (zoom, x, y))])
+        if (x, y, zoom) in server.failing:
+            return self.reply(500, b'error')
+        etag = '"%d-%d-%d"' % (zoom, x, y)
+        validators = [('ETag', etag), ('Last-Modified', 'Sat, 01 Jan 2022 00:00:00 GMT')]
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, headers=validators)
+        body = server.tile
+        if (x, y, zoom) in server.truncated:
+            body = body[:len(body) // 2]
+        self.reply(200, body, [('Content-Type', 'image/png')] + validators)
 
 
 def clean():
@@ -378,5 +479,846 @@ def test_zoom_subdivision(url):
     remove_db('test.db')
 
 
+def test_concurrent_insert(url):
+    kahelo.resetconfig()
+    kahelo.setconfig('insert', 'workers', '4')
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ jpg -url %s' % url)
+    kahelo.kahelo('-insert test.db -zoom 10-12 -track test.gpx')
+    stat = kahelo.kahelo('-count test.db -zoom 10-12 -track test.gpx')
+    check('concurrent1', stat == (24, 24, 0, 0))
+    kahelo.resetconfig()
+    remove_db('test.db')
+
+
+def test_insert_passthrough(url):
+    # tiles already in database format are stored as received
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ jpg -url %s' % url)
+    kahelo.kahelo('-insert test.db -zoom 10 -track test.gpx')
+    db = kahelo.db_factory('test.db')
+    x, y, zoom = db.list_tiles([10])[0]
+    exists, date, buffer = db.retrieve_buffer(x, y, zoom)
+    db.close()
+    u = kahelo.requests.urlopen(url.format(x=x, y=y, zoom=zoom))
+    check('passthrough1', bytes(buffer) == u.read())
+    u.close()
+    remove_db('test.db')
+
+
+def test_import_passthrough():
+    # tiles imported in the same format without drawing are copied as stored
+    img = kahelo.Image.new('RGB', (256, 256), (10, 20, 30))
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG', compress_level=1)
+    tile = buffer.getvalue()
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    db = kahelo.db_factory('test.db')
+    db.update(None, 0, 0, 1, tile)
+    db.commit()
+    db.close()
+    kahelo.kahelo('-describe test2.db -db folder -tile_ png')
+    kahelo.kahelo('-export test.db -dest test2.db -records')
+    db = kahelo.db_factory('test2.db')
+    check('import1', db.retrieve_buffer(0, 0, 1)[2] == tile)
+    db.close()
+
+    # transcoded when drawing on tiles
+    kahelo.resetconfig()
+    kahelo.setconfig('import/export', 'draw_tile_limits', 'True')
+    kahelo.kahelo('-describe test3.db -db folder -tile_ png')
+    kahelo.kahelo('-export test.db -dest test3.db -records')
+    kahelo.resetconfig()
+    db = kahelo.db_factory('test3.db')
+    exists, _, buffer = db.retrieve_buffer(0, 0, 1)
+    check('import2', exists and buffer != tile and kahelo.blob_format(buffer) == 'PNG')
+    db.close()
+    remove_db('test.db')
+    remove_db('test2.db')
+    remove_db('test3.db')
+
+
+def test_insert_resume(url):
+    kahelo.resetconfig()
+    kahelo.setconfig('insert', 'session_max', '10')
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ jpg -url %s' % url)
+    kahelo.kahelo('-insert test.db -zoom 10-12 -track test.gpx')
+    check('resume1', os.path.isfile('test.db.journal'))
+    kahelo.resetconfig()
+    kahelo.kahelo('-insert test.db -zoom 10-12 -track test.gpx -resume')
+    check('resume2', not os.path.isfile('test.db.journal'))
+    stat = kahelo.kahelo('-count test.db -zoom 10-12 -track test.gpx')
+    check('resume3', stat == (24, 24, 0, 0))
+    remove_db('test.db')
+
+
+def test_failure_log():
+    ranges = kahelo.IndexRanges([[0, 5], [8, 9]])
+    for index in (2, 0, 4, 8, 6):
+        ranges.discard(index)
+    check('failures0', ranges.ranges == [[1, 2], [3, 4]])
+
+    kahelo.resetconfig()
+    kahelo.setconfig('insert', 'number_of_attempts', '1')
+    kahelo.setconfig('insert', 'retry_rounds', '0')
+    server = ScriptedTileServer()
+    try:
+        kahelo.kahelo('-describe test.db -db kahelo -tile_ png -url %s' % server.url)
+        log = kahelo.FailureLog('test.db')
+        # failing tiles are logged
+        server.failing = set([(0, 0, 1), (1, 1, 1)])
+        kahelo.kahelo('-insert test.db -tiles 0,0,1,1 -zoom 1')
+        check('failures1', sorted(entry[:3] for entry in log.read()) == [(0, 0, 1), (1, 1, 1)])
+        # entries of tiles downloaded by a resumed session are dropped
+        server.failing = set([(1, 1, 1)])
+        kahelo.kahelo('-insert test.db -tiles 0,0,1,1 -zoom 1 -resume')
+        check('failures2', [entry[:3] for entry in log.read()] == [(1, 1, 1)])
+        with open('test.db.journal') as f:
+            journal = json.load(f)
+        check('failures3', sum(end - start for start, end in journal['failed']) == 1)
+        # and when retrying from the log
+        server.failing = set()
+        kahelo.kahelo('-insert test.db -retry_failed -zoom 1')
+        check('failures4', not os.path.isfile(log.filename) and kahelo.kahelo('-count test.db -tiles 0,0,1,1 -zoom 1') == (4, 4, 0, 0))
+    finally:
+        server.stop()
+        kahelo.resetconfig()
+        for ext in ('.journal', '.failures'):
+            if os.path.isfile('test.db' + ext):
+                os.remove('test.db' + ext)
+        remove_db('test.db')
+
+
+def test_connection_reuse():
+    server = ScriptedTileServer()
+    base = server.url.split('{zoom}')[0]
+    try:
+        # one connection serves all requests, redirections included
+        pool = kahelo.ConnectionPool(3)
+        codes = [pool.fetch(base + '%d/%d/1.png' % (zoom, x))[0] for zoom in (1, 2) for x in (0, 1)]
+        code, response, content = pool.fetch(base + 'redirect/2/3/3.png')
+        pool.close()
+        check('keepalive1', codes == [200] * 4 and code == 200 and content == server.tile)
+        check('keepalive2', pool.opened == 1 and pool.requests == 6 and server.connections == 1)
+
+        # same for a whole insertion
+        server.connections = 0
+        kahelo.kahelo('-describe test.db -db kahelo -tile_ png -url %s' % server.url)
+        kahelo.kahelo('-insert test.db -tiles 0,0,3,3 -zoom 2')
+        check('keepalive3', server.connections == 1 and len(server.requests) == 6 + 16)
+
+        # http proxy from environment is given the whole url
+        environ = dict(os.environ)
+        os.environ['http_proxy'] = base
+        os.environ['no_proxy'] = ''
+        try:
+            pool = kahelo.ConnectionPool(3)
+            code, response, content = pool.fetch('http://tiles.invalid/3/0/0.png')
+            pool.close()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        check('proxy1', code == 200 and server.requests[-1][0] == 'http://tiles.invalid/3/0/0.png')
+    finally:
+        server.stop()
+        remove_db('test.db')
+
+
+def test_rate_limits():
+    # retry-after given as seconds or http date
+    check('retry1', kahelo.retry_after_delay('5') == 5 and kahelo.retry_after_delay('-3') == 0)
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    check('retry2', 58 <= kahelo.retry_after_delay(date) <= 60)
+    check('retry3', kahelo.retry_after_delay('soon') is None and kahelo.retry_after_delay(None) is None)
+
+    # exponential backoff, randomized up to the delay, capped
+    class Options:
+        pass
+    options = Options()
+    options.insert = Options()
+    options.insert.backoff_delay = 0.5
+    options.insert.backoff_max = 3
+    kahelo.random.seed(0)
+    delays = [[kahelo.backoff_delay(options, attempt) for _ in range(200)] for attempt in range(5)]
+    check('backoff1', all(0 <= delay <= limit for row, limit in zip(delays, (0.5, 1, 2, 3, 3)) for delay in row))
+    check('backoff2', [round(max(row), 1) for row in delays] == [0.5, 1.0, 2.0, 3.0, 3.0])
+
+    # tokens are paced at rate once the burst is consumed
+    bucket = kahelo.TokenBucket(10, burst=2)
+    delays = [bucket.delay() for _ in range(5)]
+    check('bucket1', delays[:2] == [0, 0] and [round(delay, 2) for delay in delays[2:]] == [0.1, 0.2, 0.3])
+    check('bucket2', kahelo.TokenBucket(0).delay() == 0)
+    bucket = kahelo.TokenBucket(0)
+    bucket.block(5)
+    check('bucket3', 4.9 <= bucket.delay() <= 5)
+
+    # configuration files of previous versions are completed with defaults,
+    # request_delay giving the global rate
+    with open(kahelo.configfilename(), 'wt') as f:
+        f.write('[database]\ntile_validity = 3650\ncommit_period = 100\n\n'
+                '[insert]\nrequest_delay = 0.05\ntimeout = 3\nnumber_of_attempts = 3\nsession_max = 1000000\n')
+    options = Options()
+    kahelo.read_config(options)
+    kahelo.resetconfig()
+    check('config1', options.insert.max_rate == 20 and options.insert.host_max_rate == 10 and
+                     options.insert.workers == 1 and options.insert.retry_rounds == 2)
+    check('config2', options.sqlite.journal_mode == '' and options.database.scan_threads == 1 and
+                     options.database.pack_pages == 10000 and options.view.max_dim == 10000)
+
+
+def test_conditional_get():
+    server = ScriptedTileServer()
+    try:
+        kahelo.kahelo('-describe test.db -db kahelo -tile_ png -url %s' % server.url)
+        kahelo.kahelo('-insert test.db -tiles 0,0,1,1 -zoom 1')
+        db = kahelo.db_factory('test.db')
+        check('validators1', db.validators(1, 0, 1) == ('"1-1-0"', 'Sat, 01 Jan 2022 00:00:00 GMT'))
+        # expired tiles are revalidated, touched and not rewritten
+        for x in (0, 1):
+            db.touch(1000, x, 0, 1)
+        db.execute('SELECT x, tile_id FROM tiles WHERE zoom = 1 AND y = 0')
+        blobs = db.cursor.fetchall()
+        db.commit()
+        db.close()
+        del server.requests[:]
+        kahelo.kahelo('-insert test.db -tiles 0,0,1,1 -zoom 1')
+        check('validators2', sorted(server.requests) == [('/1/0/0.png', '"1-0-0"'), ('/1/1/0.png', '"1-1-0"')])
+        db = kahelo.db_factory('test.db')
+        db.execute('SELECT x, tile_id FROM tiles WHERE zoom = 1 AND y = 0')
+        check('validators3', db.cursor.fetchall() == blobs and db.exists(0, 0, 1)[1] > time.time() - 60)
+        # and forgotten with the tile
+        db.delete(1, 0, 1)
+        db.commit()
+        check('validators4', db.validators(1, 0, 1) == (None, None) and db.validators(0, 0, 1)[0] == '"1-0-0"')
+        db.close()
+    finally:
+        server.stop()
+        remove_db('test.db')
+
+
+def test_truncated_download():
+    kahelo.resetconfig()
+    kahelo.setconfig('insert', 'number_of_attempts', '1')
+    kahelo.setconfig('insert', 'retry_rounds', '0')
+    server = ScriptedTileServer()
+    try:
+        jpeg = kahelo.create_blob_from_image(kahelo.Image.new('RGB', (256, 256)), 'JPG')
+        check('truncated1', kahelo.blob_complete(server.tile) and not kahelo.blob_complete(server.tile[:-20]) and
+                            kahelo.blob_complete(jpeg) and not kahelo.blob_complete(jpeg[:len(jpeg) // 2]))
+        # complete images are stored as received, truncated ones rejected
+        server.truncated = set([(1, 0, 1)])
+        kahelo.kahelo('-describe test.db -db kahelo -tile_ png -url %s' % server.url)
+        kahelo.kahelo('-insert test.db -tiles 0,0,1,1 -zoom 1')
+        db = kahelo.db_factory('test.db')
+        check('truncated2', not db.exists(1, 0, 1)[0] and bytes(db.retrieve_buffer(0, 0, 1)[2]) == server.tile)
+        db.close()
+    finally:
+        server.stop()
+        kahelo.resetconfig()
+        for ext in ('.journal', '.failures'):
+            if os.path.isfile('test.db' + ext):
+                os.remove('test.db' + ext)
+        remove_db('test.db')
+
+
+def test_timings(url):
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png -url %s' % url)
+    kahelo.kahelo('-insert test.db -zoom 10-11 -track test.gpx -timings test.json')
+    with open('test.json') as f:
+        timings = json.load(f)
+    phases = timings['phases']
+    check('timings1', timings['command'] == 'insert')
+    check('timings2', phases['fetch']['calls'] == 13 and phases['update']['calls'] == 13)
+    check('timings3', all(phases[name]['p50'] <= phases[name]['p99'] for name in phases))
+    os.remove('test.json')
+    remove_db('test.db')
+
+
+def test_batched_update():
+    # duplicates stored by previous versions are removed with the first batch
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    # version 1 of kahelo format
+    kahelo.KaheloDatabase('test.db', 'PNG', '').close()
+    db = kahelo.db_factory('test.db')
+    for date in (1, 2):
+        db.execute('INSERT INTO tiles VALUES (?,?,?,?,?)', date, 1, 1, 2, b'')
+    writer = kahelo.TileWriter(db, 2)
+    for x, date in ((0, 3), (2, 4), (0, 5)):
+        writer.update(date, x, 0, 2, b'')
+    writer.commit()
+    check('batch1', db.count_tiles([2]) == 3)
+    check('batch2', db.exists(1, 1, 2) == (True, 2) and db.exists(0, 0, 2) == (True, 5))
+    db.close()
+    remove_db('test.db')
+
+    # images of a batch are inserted with one request
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    db = kahelo.db_factory('test.db')
+    requests = []
+    execute = db.execute
+    def tracing_execute(request, *args):
+        requests.append(request)
+        return execute(request, *args)
+    db.execute = tracing_execute
+    db.update_many([(None, x, 0, 3, b'tile %d' % x) for x in range(8)])
+    del db.execute
+    db.commit()
+    inserts = [request for request in requests if request.startswith('INSERT')]
+    check('batch3', inserts == [] and db.dedup_stats() == (8, 8))
+    check('batch4', [bytes(db.retrieve_buffer(x, 0, 3)[2]) for x in (0, 7)] == [b'tile 0', b'tile 7'])
+    db.close()
+    remove_db('test.db')
+
+
+def test_sqlite_pragmas(url):
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    with open('test.db.properties', 'a') as f:
+        f.write('\n[sqlite]\njournal_mode = wal\npage_size = 8192\n')
+    # properties are rewritten keeping the database overrides
+    kahelo.kahelo('-describe test.db -url %s' % url)
+    db = kahelo.db_factory('test.db')
+    db.execute('PRAGMA journal_mode')
+    check('pragma1', kahelo.decode_text(db.cursor.fetchone()[0]) == 'wal')
+    db.execute('PRAGMA page_size')
+    check('pragma2', db.cursor.fetchone()[0] == 8192)
+    db.close()
+    kahelo.setconfig('sqlite', 'synchronous', 'normal')
+    stat = kahelo.kahelo('-count test.db -zoom 10 -track test.gpx')
+    check('pragma3', stat == (4, 0, 0, 4))
+    options = kahelo.ArgumentParser().parse_args('-count test.db -zoom 10 -track test.gpx')
+    kahelo.read_config(options)
+    db = kahelo.db_factory('test.db', options)
+    db.execute('PRAGMA synchronous')
+    check('pragma4', db.cursor.fetchone()[0] == 1)
+    db.execute('PRAGMA journal_mode')
+    check('pragma5', kahelo.decode_text(db.cursor.fetchone()[0]) == 'wal')
+    db.close()
+    with open('test.db.properties', 'a') as f:
+        f.write('synchronous = full\n')
+    db = kahelo.db_factory('test.db', options)
+    db.execute('PRAGMA synchronous')
+    check('pragma6', db.cursor.fetchone()[0] == 2)
+    db.close()
+    kahelo.resetconfig()
+    remove_db('test.db')
+
+
+def test_migrate(url):
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ jpg -url %s' % url)
+    db = kahelo.KaheloDatabase('test.db', 'JPG', url)
+    db.close()
+    kahelo.kahelo('-insert test.db -zoom 10-11 -track test.gpx')
+    db = kahelo.db_factory('test.db')
+    check('migrate1', type(db) is kahelo.KaheloDatabase)
+    tiles = [db.retrieve_buffer(x, y, zoom) for x, y, zoom in db.list_tiles([10, 11])]
+    db.close()
+    kahelo.kahelo('-migrate test.db')
+    db = kahelo.db_factory('test.db')
+    check('migrate2', type(db) is kahelo.Kahelo2Database)
+    tiles2 = [db.retrieve_buffer(x, y, zoom) for x, y, zoom in db.list_tiles([10, 11])]
+    check('migrate3', len(tiles) == 13 and sorted(tiles) == sorted(tiles2))
+    db.close()
+    stat = kahelo.kahelo('-count test.db -zoom 10-11 -track test.gpx')
+    check('migrate4', stat == (13, 13, 0, 0))
+    remove_db('test.db')
+
+
+def test_dedup():
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    db = kahelo.db_factory('test.db')
+    for x in range(4):
+        db.update(None, x, 0, 2, b'sea')
+    db.commit()
+    check('dedup1', db.dedup_stats() == (4, 4))
+    db.close()
+    # images already stored are shared when enabling dedup
+    kahelo.kahelo('-describe test.db -dedup on')
+    db = kahelo.db_factory('test.db')
+    check('dedup2', db.dedup and db.dedup_stats() == (4, 1))
+    db.update(None, 0, 0, 2, b'land')
+    db.update(None, 1, 0, 2, b'land')
+    db.delete(2, 0, 2)
+    db.commit()
+    check('dedup3', db.dedup_stats() == (3, 2))
+    check('dedup4', [bytes(db.retrieve_buffer(x, 0, 2)[2]) for x in (0, 1, 3)] == [b'land', b'land', b'sea'])
+    db.delete(3, 0, 2)
+    db.commit()
+    check('dedup5', db.dedup_stats() == (2, 1))
+
+    # tiles and images of a batch are looked up with one request each,
+    # images repeated in a batch are stored once
+    requests = []
+    db.conn.set_trace_callback(requests.append)
+    db.update_many([(None, x, y, 3, b'sea' if y else b'land %d' % x) for x in range(10) for y in range(10)])
+    db.conn.set_trace_callback(None)
+    db.commit()
+    selects = [request for request in requests if request.startswith('SELECT')]
+    check('dedup6', len(selects) == 3 and db.dedup_stats() == (102, 12))
+    check('dedup7', bytes(db.retrieve_buffer(4, 0, 3)[2]) == b'land 4' and bytes(db.retrieve_buffer(4, 5, 3)[2]) == b'sea')
+    db.update_many([(None, x, 0, 3, b'sea') for x in range(10)])
+    db.commit()
+    check('dedup8', db.dedup_stats() == (102, 2))
+    db.close()
+    remove_db('test.db')
+
+
+def test_mbtiles():
+    kahelo.kahelo('-describe test.db -db mbtiles -tile_ png')
+    db = kahelo.db_factory('test.db')
+    db.update(None, 1, 0, 1, b'tile')
+    db.commit()
+    # rows numbered from the south
+    db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles')
+    check('mbtiles1', db.cursor.fetchall() == [(1, 1, 1)])
+    db.execute('SELECT name, value FROM metadata')
+    metadata = dict((kahelo.decode_text(n), kahelo.decode_text(v)) for n, v in db.cursor.fetchall())
+    check('mbtiles2', metadata['format'] == 'png' and metadata['minzoom'] == '1')
+    check('mbtiles3', metadata['bounds'] == '0.000000,0.000000,180.000000,85.051129')
+    db.close()
+    remove_db('test.db')
+
+    # tiles in a view on shared images, as written by mbutil, are read only
+    tile = kahelo.create_blob_from_image(kahelo.Image.new('RGB', (256, 256), (0, 128, 255)), 'PNG')
+    conn = kahelo.sqlite3.connect('test2.db')
+    conn.executescript('''
+        CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, tile_id text);
+        CREATE TABLE images (tile_data blob, tile_id text);
+        CREATE TABLE metadata (name text, value text);
+        CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+            map.tile_row AS tile_row, images.tile_data AS tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
+        ''')
+    conn.execute("INSERT INTO images VALUES (?, 'blue')", (tile,))
+    conn.executemany("INSERT INTO map VALUES (?, ?, ?, 'blue')", [(1, x, y) for x in (0, 1) for y in (0, 1)])
+    conn.commit()
+    conn.close()
+    kahelo.kahelo('-describe test2.db -db mbtiles -tile_ png')
+    check('mbtiles4', kahelo.kahelo('-count test2.db -records') == (4, 4, 0, 0) and
+                      kahelo.kahelo('-count test2.db -tiles 0,0,1,1 -zoom 1') == (4, 4, 0, 0))
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    kahelo.kahelo('-import test.db -tiles 0,0,1,1 -zoom 1 -source test2.db')
+    db = kahelo.db_factory('test.db')
+    check('mbtiles5', db.count_tiles([1]) == 4 and bytes(db.retrieve_buffer(0, 1, 1)[2]) == tile)
+    db.close()
+    remove_db('test.db')
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    kahelo.kahelo('-export test2.db -records -dest test.db')
+    check('mbtiles6', kahelo.kahelo('-count test.db -records') == (4, 4, 0, 0))
+    remove_db('test.db')
+    db = kahelo.db_factory('test2.db')
+    try:
+        db.delete(0, 0, 1)
+        readonly = False
+    except kahelo.CustomException:
+        readonly = True
+    db.close()
+    check('mbtiles7', readonly and kahelo.kahelo('-count test2.db -records') == (4, 4, 0, 0))
+    remove_db('test2.db')
+
+
+def test_tile_box():
+    for db_format in ('kahelo', 'rmaps', 'mbtiles', 'folder', 'maverick', 'bundle'):
+        kahelo.kahelo('-describe test.db -db %s -tile_ png' % db_format)
+        db = kahelo.db_factory('test.db')
+        for x in range(4):
+            for y in range(4):
+                db.update(None, x, y, 3, b'')
+        db.commit()
+        box = (1, 2, 2, 3)
+        tiles = set((x, y, 3) for x in (1, 2) for y in (2, 3))
+        check('box1 ' + db_format, set(db.list_tiles([3], box)) == tiles)
+        check('box2 ' + db_format, db.count_tiles([3], box) == 4 and db.count_tiles([3]) == 16)
+        db.close()
+        stat = kahelo.kahelo('-count test.db -tiles 2,2,5,5 -zoom 3 -inside')
+        check('box3 ' + db_format, stat == (4, 4, 0, 0))
+        remove_db('test.db')
+
+
+def test_tile_order():
+    tiles = [(x, y, 2) for x in range(4) for y in range(4)] + [(1, 0, 1), (0, 0, 1)]
+    for order, first in (('hilbert', [(0, 0, 2), (1, 0, 2), (1, 1, 2), (0, 1, 2)]),
+                         ('zorder',  [(0, 0, 2), (0, 1, 2), (1, 0, 2), (1, 1, 2)])):
+        tileset = kahelo.TileSet(iter(tiles), len(tiles))
+        tileset.order(order)
+        ordered = list(tileset)
+        check('order1 ' + order, sorted(ordered) == sorted(tiles) and len(ordered) == len(tiles))
+        check('order2 ' + order, ordered[:2] == [(0, 0, 1), (1, 0, 1)] and ordered[2:6] == first)
+
+    # consecutive tiles along the Hilbert curve are neighbours
+    tileset = kahelo.TileSet(iter([(x, y, 4) for x in range(16) for y in range(16)]), 256)
+    tileset.order('hilbert')
+    ordered = list(tileset)
+    check('order3', all(abs(x1 - x2) + abs(y1 - y2) == 1
+                        for (x1, y1, _), (x2, y2, _) in zip(ordered, ordered[1:])))
+
+    # -records tile sets are not loaded in memory to be sorted
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    db = kahelo.db_factory('test.db')
+    db.update_many([(None, x, 0, 3, b'') for x in range(8)])
+    db.commit()
+    db.close()
+    kahelo.kahelo('-delete test.db -records -order hilbert')
+    check('order4', kahelo.kahelo('-count test.db -records') == (8, 8, 0, 0))
+    remove_db('test.db')
+
+
+def test_iter_tiles():
+    page_size = kahelo.ITER_PAGE_SIZE
+    kahelo.ITER_PAGE_SIZE = 3
+    for db_format in ('kahelo', 'rmaps', 'mbtiles', 'folder', 'bundle'):
+        kahelo.kahelo('-describe test.db -db %s -tile_ png' % db_format)
+        db = kahelo.db_factory('test.db')
+        for x in range(10):
+            db.update(None, x, 0, 4, b'')
+        db.commit()
+        # tiles replaced while iterating are not seen twice
+        tiles = []
+        for x, y, zoom in db.iter_tiles([3, 4]):
+            tiles.append((x, y, zoom))
+            db.update(None, x, y, zoom, b'new')
+        check('iter1 ' + db_format, sorted(tiles) == [(x, 0, 4) for x in range(10)])
+        db.commit()
+        db.close()
+        stat = kahelo.kahelo('-count test.db -records')
+        check('iter2 ' + db_format, stat == (10, 10, 0, 0))
+        remove_db('test.db')
+    kahelo.ITER_PAGE_SIZE = page_size
+
+    # tiles streamed from the database are not prefetched
+    prefetched = []
+    prefetch = kahelo.TileDatabase.prefetch
+    def counting_prefetch(db, zoom, box=None):
+        prefetch(db, zoom, box)
+        prefetched.append(len(db.presence[zoom].dates))
+    kahelo.TileDatabase.prefetch = counting_prefetch
+    try:
+        kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+        db = kahelo.db_factory('test.db')
+        db.update_many([(None, x, y, 6, b'') for x in range(20) for y in range(20)])
+        db.commit()
+        db.close()
+        stat = kahelo.kahelo('-count test.db -records')
+        check('iter3', stat == (400, 400, 0, 0) and prefetched == [])
+        kahelo.kahelo('-describe test2.db -db kahelo -tile_ png')
+        kahelo.kahelo('-export test.db -records -dest test2.db')
+        check('iter4', prefetched == [])
+        stat = kahelo.kahelo('-count test.db -tiles 0,0,1,1 -zoom 6')
+        check('iter5', stat == (4, 4, 0, 0) and prefetched == [4])
+    finally:
+        kahelo.TileDatabase.prefetch = prefetch
+    remove_db('test.db')
+    remove_db('test2.db')
+
+
+def test_prefetch():
+    # prefetched presence gives the same answers as the database
+    def uncached_exists(db, x, y, zoom):
+        presence = db.presence
+        db.presence = dict()
+        try:
+            return db.exists(x, y, zoom)
+        finally:
+            db.presence = presence
+
+    def check_presence(tag, db, box):
+        xmin, ymin, xmax, ymax = box
+        inside = [(x, y) for x in range(8) for y in range(8)
+                  if xmin <= x <= xmax and ymin <= y <= ymax]
+        covered = all(db.prefetched(x, y, 5) is not None for x, y in inside)
+        outside = all(db.prefetched(x, y, 5) is None
+                      for x in range(8) for y in range(8) if (x, y) not in inside)
+        same = all(db.exists(x, y, 5) == uncached_exists(db, x, y, 5)
+                   for x in range(8) for y in range(8))
+        dates = sorted((x, y, date) for x, y, date in db.tile_dates(5, box))
+        expected = sorted((x, y, uncached_exists(db, x, y, 5)[1])
+                          for x, y in inside if uncached_exists(db, x, y, 5)[0])
+        check(tag, covered and outside and same and dates == expected)
+
+    box = (2, 2, 5, 5)
+    for db_format in ('kahelo', 'rmaps', 'mbtiles', 'folder', 'maverick', 'bundle'):
+        kahelo.kahelo('-describe test.db -db %s -tile_ png' % db_format)
+        db = kahelo.db_factory('test.db')
+        for x in range(8):
+            for y in range(8):
+                if (x + y) % 3 == 0:
+                    db.update(1000 + x, x, y, 5, b'tile')
+        db.commit()
+        db.prefetch(5, box)
+        check_presence('prefetch1 ' + db_format, db, box)
+
+        # added, replaced and deleted tiles, inside and outside the box
+        db.update(2000, 3, 4, 5, b'new')
+        db.update(2000, 7, 6, 5, b'new')
+        db.update(3000, 3, 3, 5, b'new')
+        db.delete(2, 4, 5)
+        db.delete(7, 2, 5)
+        db.commit()
+        check_presence('prefetch2 ' + db_format, db, box)
+        check('prefetch3 ' + db_format, db.exists(3, 4, 5)[0] and not db.exists(2, 4, 5)[0])
+        db.close()
+        remove_db('test.db')
+
+
+def test_zoom_stats():
+    for db_format in ('kahelo', 'rmaps', 'mbtiles', 'folder', 'maverick'):
+        kahelo.kahelo('-describe test.db -db %s -tile_ png' % db_format)
+        db = kahelo.db_factory('test.db')
+        for x, y in ((0, 0), (1, 0), (2, 0), (3, 1)):
+            db.update(1000 + x, x, y, 3, b'ab')
+        db.update(1001, 1, 0, 3, b'abcd')
+        db.delete(2, 0, 3)
+        db.commit()
+        stats = db.zoom_stats()
+        check('stats1 ' + db_format, list(stats) == [3] and stats[3][:4] == (3, 8, 2, 4) and stats[3][6:] == (0, 0, 3, 1))
+        check('stats2 ' + db_format, db.count_tiles([3]) == 3 and db.count_tiles([4]) == 0)
+        db.close()
+        kahelo.kahelo('-rebuild test.db')
+        db = kahelo.db_factory('test.db')
+        check('stats3 ' + db_format, db.zoom_stats() == stats)
+        db.close()
+        remove_db('test.db')
+
+    # statistics are not maintained for existing databases until rebuilt
+    kahelo.kahelo('-describe test.db -db folder -tile_ png')
+    os.makedirs('test.db')
+    db = kahelo.db_factory('test.db')
+    check('stats4', db.zoom_stats() is None)
+    db.rebuild_stats()
+    db.update(None, 0, 0, 3, b'ab')
+    # not saved, statistics of an interrupted session are ignored
+    db.manifest.close()
+    db = kahelo.db_factory('test.db')
+    check('stats5', db.zoom_stats() is None)
+    db.close()
+
+    # tiles added by other applications without manifest are not counted,
+    # replacing or deleting them leaves the statistics dirty
+    db = kahelo.db_factory('test.db')
+    db.rebuild_stats()
+    db.commit()
+    db.close()
+    os.remove('test.db.manifest')
+    for zoom in (4, 5):
+        os.makedirs(os.path.join('test.db', str(zoom), '0'))
+        with open(os.path.join('test.db', str(zoom), '0', '0.png'), 'wb') as f:
+            f.write(b'ab')
+    db = kahelo.db_factory('test.db')
+    check('stats6', db.zoom_stats() is not None)
+    db.update(None, 0, 0, 4, b'abc')
+    db.delete(0, 0, 5)
+    db.commit()
+    check('stats7', db.zoom_stats() is None)
+    db.close()
+    db = kahelo.db_factory('test.db')
+    check('stats8', db.zoom_stats() is None and db.count_tiles([4, 5]) == 1)
+    db.close()
+    remove_db('test.db')
+
+
+def test_connection_pool():
+    for db_format in ('kahelo', 'rmaps', 'mbtiles'):
+        kahelo.kahelo('-describe test.db -db %s -tile_ png' % db_format)
+        db = kahelo.db_factory('test.db')
+        for x in range(20):
+            db.update(None, x, 0, 5, b'tile %d' % x)
+        db.commit()
+
+        # readers in threads while the opening thread writes
+        errors = []
+        connections = []
+        def reader():
+            try:
+                connections.append(db.conn)
+                for _ in range(50):
+                    for x in range(20):
+                        exists, date, tile = db.retrieve_buffer(x, 0, 5)
+                        if not exists or tile not in (b'tile %d' % x, b'new %d' % x):
+                            errors.append((x, tile))
+                    if db.count_tiles([5]) != 20 or not db.exists(19, 0, 5)[0]:
+                        errors.append('count')
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=reader) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for _ in range(10):
+            for x in range(20):
+                db.update(None, x, 0, 5, b'new %d' % x)
+            db.commit()
+        for thread in threads:
+            thread.join()
+        check('pool1 ' + db_format, errors == [] and len(set(connections)) == 8 and db.conn not in connections)
+
+        # only the opening thread writes
+        def writer():
+            try:
+                db.update(None, 0, 1, 5, b'')
+            except kahelo.sqlite3.OperationalError as e:
+                errors.append(e)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        thread.join()
+        check('pool2 ' + db_format, len(errors) == 1)
+
+        # connections of ended threads are closed
+        for _ in range(10):
+            thread = threading.Thread(target=db.exists, args=(0, 0, 5))
+            thread.start()
+            thread.join()
+        check('pool3 ' + db_format, len(db.connections.readers) == 1)
+        db.close()
+        remove_db('test.db')
+
+
+def test_pack():
+    kahelo.kahelo('-describe test.db -db kahelo -tile_ png')
+    db = kahelo.db_factory('test.db')
+    for x in range(20):
+        for y in range(10):
+            db.update(None, x, y, 10, os.urandom(2000))
+    db.commit()
+    check('pack1', db.pragma('auto_vacuum') == 2 and db.pragma('freelist_count') == 0)
+    db.close()
+
+    # free pages are released after deleting
+    kahelo.kahelo('-delete test.db -tiles 0,0,9,9 -zoom 10')
+    db = kahelo.db_factory('test.db')
+    check('pack2', db.pragma('freelist_count') == 0)
+
+    # bounded by threshold and number of pages
+    for x in range(10, 15):
+        for y in range(10):
+            db.delete(x, y, 10)
+    check('pack3', db.reclaim(0.99, 0) == 0)
+    free = db.pragma('freelist_count')
+    check('pack4', db.reclaim(0.1, 5) == 5 and db.pragma('freelist_count') == free - 5)
+
+    # no incremental reclaim for databases without auto vacuum until packed
+    db.execute('PRAGMA auto_vacuum = NONE')
+    db.execute('VACUUM')
+    for x in range(15, 20):
+        for y in range(10):
+            db.delete(x, y, 10)
+    check('pack5', db.reclaim(0.1, 0) == 0 and db.pragma('freelist_count') > 0)
+    db.close()
+    kahelo.kahelo('-pack test.db')
+    db = kahelo.db_factory('test.db')
+    check('pack6', db.pragma('auto_vacuum') == 2 and db.pragma('freelist_count') == 0)
+    db.close()
+    remove_db('test.db')
+
+
+def test_scan_folder():
+    kahelo.kahelo('-describe test.db -db folder -tile_ png')
+    db = kahelo.db_factory('test.db')
+    for x in range(10):
+        for y in range(5):
+            db.update(None, x, y, 6, b'')
+    db.commit()
+    # entries not following the layout are ignored
+    os.makedirs('test.db/6/tmp')
+    for name in ('test.db/6/readme.txt', 'test.db/6/3/4.png.tmp', 'test.db/6/3/a.png'):
+        open(name, 'w').close()
+
+    tiles = set((x, y) for x in range(10) for y in range(5))
+    box = (2, 1, 4, 3)
+    tiles_box = set((x, y) for x in range(2, 5) for y in range(1, 4))
+    scandir = kahelo.scandir
+    for threads in (1, 4):
+        for listing in ('scandir', 'listdir'):
+            kahelo.scandir = scandir if listing == 'scandir' else None
+            scan = [(x, y) for x, y, _ in kahelo.scan_tile_files('test.db/6', '.png', None, threads)]
+            scan_box = [(x, y) for x, y, _ in kahelo.scan_tile_files('test.db/6', '.png', box, threads)]
+            check('scan1 %d %s' % (threads, listing), len(scan) == 50 and set(scan) == tiles)
+            check('scan2 %d %s' % (threads, listing), len(scan_box) == 9 and set(scan_box) == tiles_box)
+    kahelo.scandir = scandir
+
+    # threads are stopped when leaving the iteration
+    active = threading.active_count()
+    for x, y, filename in kahelo.scan_tile_files('test.db/6', '.png', None, 4):
+        break
+    time.sleep(0.1)
+    check('scan3', threading.active_count() == active)
+    db.close()
+    remove_db('test.db')
+
+
+def test_folder_manifest():
+    kahelo.kahelo('-describe test.db -db folder -tile_ png')
+    db = kahelo.db_factory('test.db')
+    for x in range(3):
+        for y in range(3):
+            db.update(None, x, y, 5, b'ab')
+    db.update(None, 0, 0, 6, b'ab')
+    db.commit()
+    # served from the manifest
+    os.remove('test.db/5/0/0.png')
+    check('manifest1', db.exists(0, 0, 5)[0] and db.count_tiles([5], (0, 0, 1, 1)) == 4)
+    db.close()
+
+    # changes made by other applications are found when opening
+    with open('test.db/5/1/5.png', 'wb') as f:
+        f.write(b'abcd')
+    os.makedirs('test.db/5/7')
+    with open('test.db/5/7/1.png', 'wb') as f:
+        f.write(b'abc')
+    shutil.rmtree('test.db/6')
+    db = kahelo.db_factory('test.db')
+    tiles = set((x, y, 5) for x in range(3) for y in range(3)) - set([(0, 0, 5)]) | set([(1, 5, 5), (7, 1, 5)])
+    check('manifest2', not db.exists(0, 0, 5)[0] and db.exists(1, 5, 5)[0] and db.exists(7, 1, 5)[0])
+    check('manifest3', set(db.list_tiles([5, 6])) == tiles and db.count_tiles([5, 6], (0, 0, 9, 9)) == 10)
+    check('manifest4', db.zoom_stats() == {5: (10, 23, 2, 4) + db.zoom_stats()[5][4:6] + (0, 0, 7, 5)})
+    db.close()
+
+    # manifest of existing databases created when rebuilding statistics
+    os.remove('test.db.manifest')
+    db = kahelo.db_factory('test.db')
+    check('manifest5', db.manifest is None)
+    db.rebuild_stats()
+    check('manifest6', set(db.list_tiles([5, 6])) == tiles)
+    db.close()
+    remove_db('test.db')
+
+
+def test_bundle():
+    kahelo.kahelo('-describe test.db -db bundle -tile_ png')
+    db = kahelo.db_factory('test.db')
+    for x in (0, 1, 127, 128):
+        db.update(1000 + x, x, 5, 8, b'tile %d' % x)
+    db.update(None, 3, 3, 9, b'')
+    db.commit()
+    check('bundle1', sorted(os.listdir('test.db/8')) == ['0_0.bundle', '1_0.bundle'])
+    check('bundle2', db.exists(127, 5, 8) == (True, 1127) and db.exists(2, 5, 8) == (False, None))
+    check('bundle3', db.retrieve_buffer(1, 5, 8) == (True, 1001, b'tile 1') and db.retrieve_buffer(3, 3, 9)[::2] == (True, b''))
+    check('bundle4', db.list_tiles([8], (100, 0, 200, 9)) == [(127, 5, 8), (128, 5, 8)] and db.count_tiles([8, 9]) == 5)
+
+    # images replaced and deleted stay in the file until compaction
+    db.update(2000, 0, 5, 8, b'new tile 0')
+    db.delete(1, 5, 8)
+    size = os.path.getsize('test.db/8/0_0.bundle')
+    db.reclaim(0.9, 0)
+    check('bundle5', os.path.getsize('test.db/8/0_0.bundle') == size and db.retrieve_buffer(0, 5, 8)[2] == b'new tile 0')
+    fsync = kahelo.os.fsync
+    synced = []
+    def counting_fsync(fd):
+        synced.append(fd)
+        fsync(fd)
+    kahelo.os.fsync = counting_fsync
+    try:
+        db.pack()
+    finally:
+        kahelo.os.fsync = fsync
+    check('bundle6a', len(synced) == 1 and sorted(os.listdir('test.db/8')) == ['0_0.bundle', '1_0.bundle'])
+    check('bundle6', os.path.getsize('test.db/8/0_0.bundle') == kahelo.BUNDLE_HEADER + len(b'new tile 0tile 127'))
+    check('bundle7', db.retrieve_buffer(0, 5, 8) == (True, 2000, b'new tile 0') and not db.exists(1, 5, 8)[0])
+
+    # empty bundles are removed
+    db.delete(128, 5, 8)
+    db.pack()
+    check('bundle8', os.listdir('test.db/8') == ['0_0.bundle'])
+    db.close()
+    stat = kahelo.kahelo('-count test.db -records')
+    check('bundle9', stat == (3, 1, 2, 0))
+    remove_db('test.db')
+
+
 if __name__ == '__main__':
     main()